@@ -0,0 +1,174 @@
+#%% Import packages
+import os
+import json
+import zlib
+import struct
+import numpy as np
+
+#%% Define classes
+
+# Run artifacts: several named arrays and a metadata dict in one file.
+#
+#   magic 'TRMART01' | array blocks, each 64-byte aligned | JSON header |
+#   header offset and length (two little-endian uint64)
+#
+# The header, at the end so that arrays can be written as they come,
+# records each array's dtype and shape and how it is stored. An
+# uncompressed array is one raw C-order block that readers memory-map; a
+# compressed one is cut along its first axis into chunks of chunk_rows rows
+# (a period of an elevation cube, say), each deflated separately with its
+# offset and length in the header, so a window of periods only inflates the
+# chunks it touches. Integer arrays can be stored in the narrowest integer
+# type that holds their values (labels of 100 households fit in uint8).
+
+magic = b'TRMART01'
+alignment = 64
+
+class artifact(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError("%s is not a run artifact" % path)
+            f.seek(-16, os.SEEK_END)
+            offset, length = struct.unpack('<QQ', f.read(16))
+            f.seek(offset)
+            self.header = json.loads(f.read(length).decode('utf-8'))
+        self.meta = self.header['meta']
+        self.arrays = self.header['arrays']
+
+    def names(self):
+        return list(self.arrays.keys())
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def shape(self, name):
+        return tuple(self.arrays[name]['shape'])
+
+    def dtype(self, name):
+        return np.dtype(self.arrays[name]['stored_dtype'])
+
+    def __getitem__(self, name):
+        return self.read(name)
+
+    # An array, or a window of it along its first axis (an int or a slice
+    # with step 1). Raw arrays come back memory-mapped read-only unless
+    # mmap = False; upcast = True converts narrowed integers back to the
+    # dtype they were written with.
+
+    def read(self, name, window = None, mmap = True, upcast = False):
+        spec = self.arrays[name]
+        shape = tuple(spec['shape'])
+        dtype = np.dtype(spec['stored_dtype'])
+        if spec['compression'] is None:
+            if len(shape) == 0 or np.prod(shape) == 0:
+                a = np.fromfile(self.path, dtype, int(np.prod(shape)), offset = spec['offset']).reshape(shape)
+            else:
+                a = np.memmap(self.path, dtype, 'r', spec['offset'], shape)
+            if window is not None:
+                a = a[window]
+            if not mmap:
+                a = np.array(a)
+        else:
+            a = self.read_chunks(spec, shape, dtype, window)
+        if upcast and spec['dtype'] != spec['stored_dtype']:
+            a = a.astype(spec['dtype'])
+        return a
+
+    def read_chunks(self, spec, shape, dtype, window):
+        if len(shape) == 0:
+            start, stop, squeeze = 0, 0, False
+        elif window is None:
+            start, stop, squeeze = 0, shape[0], False
+        elif isinstance(window, slice):
+            start, stop, step = window.indices(shape[0])
+            if step != 1:
+                raise ValueError("Only windows with step 1 are supported")
+            squeeze = False
+        else:
+            start = int(window) % shape[0]
+            stop, squeeze = start + 1, True
+        rows = spec['chunk_rows']
+        out = np.empty((max(stop - start, 0),) + shape[1:] if len(shape) > 0 else (), dtype)
+        first, last = start // rows, (stop + rows - 1) // rows if stop > start else start // rows
+        with open(self.path, 'rb') as f:
+            if len(shape) == 0:
+                first, last = 0, 1
+            for c in range(first, last):
+                offset, length = spec['chunks'][c]
+                f.seek(offset)
+                data = np.frombuffer(zlib.decompress(f.read(length)), dtype)
+                if len(shape) == 0:
+                    return data.reshape(())
+                data = data.reshape((-1,) + shape[1:])
+                lo = max(start, c * rows)
+                hi = min(stop, c * rows + data.shape[0])
+                out[(lo - start):(hi - start)] = data[(lo - c * rows):(hi - c * rows)]
+        return out[0] if squeeze else out
+
+#%% Define functions
+
+# The narrowest integer dtype holding the values of a (unsigned when none
+# is negative); other arrays keep their dtype.
+
+def narrow_dtype(a):
+    if a.dtype.kind not in 'iu' or a.size == 0:
+        return a.dtype
+    lo, hi = int(a.min()), int(a.max())
+    types = (np.uint8, np.uint16, np.uint32, np.uint64) if lo >= 0 else (np.int8, np.int16, np.int32, np.int64)
+    for t in types:
+        info = np.iinfo(t)
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(t)
+    return a.dtype
+
+# Write arrays (a dict of name -> array) and meta (JSON-able) to path.
+# compress is None or a zlib level, for all arrays or, as a dict, per
+# array; chunk_rows is the number of rows along the first axis per chunk
+# (an int or a dict). The file is written under a temporary name, unique to
+# the process, and renamed into place, so processes writing the same result
+# at once do not corrupt it.
+
+def write_artifact(path, arrays, meta = None, compress = None, chunk_rows = 1, narrow = True):
+    header = {'version':1, 'meta':meta if meta is not None else {}, 'arrays':{}}
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(magic)
+        for name, a in arrays.items():
+            a = np.asarray(a)
+            stored = narrow_dtype(a) if narrow else a.dtype
+            a = np.asarray(a, dtype = stored, order = 'C')
+            level = compress.get(name) if isinstance(compress, dict) else compress
+            rows = chunk_rows.get(name, 1) if isinstance(chunk_rows, dict) else chunk_rows
+            spec = {'dtype':np.asarray(arrays[name]).dtype.str, 'stored_dtype':stored.str,
+                    'shape':list(a.shape), 'compression':None if level is None else 'zlib'}
+            f.write(b'\0' * (- f.tell() % alignment))
+            if level is None:
+                spec['offset'] = f.tell()
+                f.write(a.tobytes())
+            else:
+                spec['chunk_rows'] = int(rows)
+                spec['chunks'] = []
+                blocks = [a] if a.ndim == 0 else [ a[i:(i + rows)] for i in range(0, max(a.shape[0], 1), rows) ]
+                for block in blocks:
+                    data = zlib.compress(np.ascontiguousarray(block).tobytes(), level)
+                    spec['chunks'].append((f.tell(), len(data)))
+                    f.write(data)
+            header['arrays'][name] = spec
+        text = json.dumps(header, default = to_builtin).encode('utf-8')
+        offset = f.tell()
+        f.write(text)
+        f.write(struct.pack('<QQ', offset, len(text)))
+    os.replace(tmp, path)
+
+def read_artifact(path, mmap = True):
+    art = artifact(path)
+    return dict((name, art.read(name, mmap = mmap)) for name in art.names()), art.meta
+
+def to_builtin(x):
+    if isinstance(x, np.generic):
+        return x.item()
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    raise TypeError("Cannot convert %r to JSON" % (x,))
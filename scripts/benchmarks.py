@@ -0,0 +1,363 @@
+#%% Import packages
+import os
+import sys
+import json
+import time
+import platform
+import datetime
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+from scipy.signal import argrelextrema
+
+import squarify as sq
+
+import trm
+from trm import polder, preferences, rasterize_plots, aggrade_patches, auction, instant_runoff
+
+#%% Define functions
+
+# Build a polder with a breach and a synthetic elevation cube, in which every
+# layer rises by an amount that decays with distance from the breach. This
+# stands in for polder.aggrade when only the decision side is being timed.
+
+def synthetic_polder(n_households, x = 500, y = 300, horizon = 6, seed = 0, **kwargs):
+    pdr = polder(x = x, y = y, time_horizon = horizon, n_households = n_households,
+                 border_height = 0.5, amplitude = 1.5, noise = 0.05, seed = seed, **kwargs)
+    pdr.add_breach(0, y / 2, horizon)
+    dz = 0.05 * np.exp(- pdr.breaches[0].dist / (0.4 * x))
+    for i in range(1, horizon + 1):
+        pdr.elevation_cube[i] = pdr.elevation_cube[i - 1] + dz
+    for hh in pdr.households.values():
+        hh.discount = 0.15
+    return pdr
+
+# Hourly tides with the two main semidiurnal constituents (M2 and S2, so
+# that there are springs and neaps) and a little noise, centred and raised
+# by offset like the p32 record in test().
+
+def synthetic_tides(n_days = 14, amplitude = 1.2, offset = 0.25, seed = 0):
+    rng = np.random.RandomState(seed)
+    index = pd.date_range('2015-05-15 01:00', periods = int(n_days * 24) + 1, freq = 'H')
+    t = np.arange(index.size, dtype = np.double)
+    h = amplitude * (np.cos(2 * np.pi * t / 12.42) + 0.3 * np.cos(2 * np.pi * t / 12.0))
+    h += 0.02 * rng.standard_normal(t.size)
+    return pd.Series(h - h.mean() + offset, index = index, name = 'pressure')
+
+def run_times(f, repeat = 3):
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t0)
+    return times
+
+def best_time(f, repeat = 3):
+    return min(run_times(f, repeat))
+
+# Wall time of calc_eu_series and calc_eu against the number of workers.
+
+def eu_scaling(n_households = (100, 10000), workers = (1, 2, 4, 8, 16, 32),
+               executors = ('thread', 'process'), horizon = 4, repeat = 3):
+    results = []
+    for n in n_households:
+        pdr = synthetic_polder(n, horizon = horizon + 1)
+        profit = pdr.calc_profit(0.8, 5.0, pdr.elevation_cube[:horizon + 1], False)
+        for executor in executors:
+            for w in workers:
+                t_series = best_time(lambda: pdr.calc_eu_series(0.8, 5.0, 0.0, 1.0, horizon, save = False,
+                                                                n_workers = w, executor = executor),
+                                     repeat)
+                if executor == 'thread':
+                    t_eu = best_time(lambda: pdr.calc_eu(profit, False, n_workers = w), repeat)
+                else:
+                    t_eu = np.nan
+                results.append((n, executor, w, t_series, t_eu))
+                print("%6d households, %-7s %2d workers: calc_eu_series %.3f s, calc_eu %.3f s" %
+                      (n, executor, w, t_series, t_eu))
+    return results
+
+# Memory traffic of one calc_eu_series call, traced with tracemalloc (numpy
+# reports its array buffers to it). Returns the peak traced size and the
+# number and total size of the allocations made during the call, counted
+# from a snapshot of every allocation site.
+
+def eu_allocations(n_households = 100, horizon = 10, x = 500, y = 300):
+    pdr = synthetic_polder(n_households, x = x, y = y, horizon = horizon)
+    tracemalloc.start(1)
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    pdr.calc_eu_series(0.8, 5.0, 0.0, 1.0, horizon, save = False)
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    diff = after.compare_to(before, 'lineno')
+    n_blocks = sum(max(d.count_diff, 0) for d in diff)
+    size = sum(max(d.size_diff, 0) for d in diff)
+    print("%d households, horizon %d, %dx%d: peak %.1f MB, %d blocks / %.1f MB retained" %
+          (n_households, horizon, y, x, peak / 2.0**20, n_blocks, size / 2.0**20))
+    return (peak, n_blocks, size)
+
+# Time to lay out parcels for n households and paint them into the owners
+# raster, with the vectorized splitter and, where it is affordable, with
+# squarify as build_plots uses it.
+
+def plot_scaling(scales = ((100, 500, 300), (10000, 2000, 1500), (100000, 5000, 3000)),
+                 gini = 0.3, squarify_max = 10000, repeat = 3):
+    results = []
+    alpha = (1.0 / gini + 1.0) / 2.0
+    for n, x, y in scales:
+        np.random.seed(0)
+        weights = np.random.pareto(alpha, size = n)
+        pdr = polder(x = x, y = y, time_horizon = 0, seed = 0)
+        t_split = best_time(lambda: pdr.build_plots(weights, method = 'split'), repeat)
+        plots = pdr.plots
+        t_raster = best_time(lambda: rasterize_plots(plots, (y, x)), repeat)
+        if n <= squarify_max:
+            t_sq = best_time(lambda: pdr.build_plots(weights, method = 'squarify'), repeat)
+        else:
+            t_sq = np.nan
+        results.append((n, x, y, t_split, t_raster, t_sq))
+        print("%6d households, %dx%d: split %.3f s, rasterize %.3f s, squarify %.3f s" %
+              (n, y, x, t_split, t_raster, t_sq))
+    return results
+
+#==============================================================================
+# BENCHMARK SUITE
+#==============================================================================
+
+# Problem sizes. tide_days is the length of the synthetic tide record the
+# aggradation cases run over, shorter on larger grids to keep them in
+# minutes; results report the number of time steps.
+
+scales = {'small':{'n_households':100, 'x':500, 'y':300, 'tide_days':14},
+          'medium':{'n_households':1000, 'x':1600, 'y':1000, 'tide_days':3},
+          'large':{'n_households':10000, 'x':5000, 'y':3000, 'tide_days':1}}
+
+# Everything the cases of one scale share: a synthetic polder with an
+# elevation cube of horizon + 1 layers below the last, the tides and water
+# levels and the parameters of test(). On the synthetic polder every
+# household prefers no TRM, which the decision rules settle at once, so
+# they run on contested preferences instead: EU drawn uniformly between 0
+# and the mean wealth, which splits the favorites evenly and makes the
+# auction trade.
+
+def scale_context(scale, seed = 0, horizon = 4):
+    spec = scales[scale]
+    pdr = synthetic_polder(spec['n_households'], x = spec['x'], y = spec['y'], horizon = horizon + 1,
+                           seed = seed, plot_method = 'split')
+    tides = synthetic_tides(spec['tide_days'], seed = seed)
+    pressure = tides.values
+    ctx = {'scale':scale, 'spec':spec, 'seed':seed, 'polder':pdr, 'tides':tides, 'horizon':horizon,
+           'MW':float(np.mean(pressure)), 'MHW':float(np.mean(pressure[argrelextrema(pressure, np.greater)[0]])),
+           'ws':((0.03 / 1000) ** 2 * 1650 * 9.8) / 0.018, 'rho':1100.0, 'SSC':0.2}
+    wealth = np.mean([ hh.wealth for hh in pdr.households.values() ])
+    eu = np.random.RandomState(seed).uniform(0.0, wealth, (len(pdr.households), horizon))
+    ctx['preferences'] = preferences(pdr.hh_ids(), eu)
+    return ctx
+
+# The cases. Each takes a scale context and returns the function to time
+# and a dict describing the work it does. Cases must leave the context as
+# they found it: polder.aggrade writes the top layer of the cube, which
+# nothing else reads, and auctions restore the households' wealth.
+
+def case_aggrade_patches(ctx):
+    pdr, tides = ctx['polder'], ctx['tides']
+    sed_load = ctx['SSC'] * pdr.breaches[0].scaled_dist ** -2.3
+    z0 = pdr.elevation_cube[0]
+    f = lambda: aggrade_patches(tides, tides.index, ctx['ws'], ctx['rho'], sed_load, 0, 0, z0, pdr.border_height)
+    return f, {'steps':tides.size - 1}
+
+def case_polder_aggrade(ctx):
+    pdr, tides = ctx['polder'], ctx['tides']
+    f = lambda: pdr.aggrade(tides, ctx['ws'], ctx['rho'], ctx['SSC'], 0, 0, pdr.time_horizon)
+    return f, {'steps':tides.size - 1}
+
+def case_calc_profit(ctx):
+    pdr = ctx['polder']
+    cube = pdr.elevation_cube[:(ctx['horizon'] + 1)]
+    f = lambda: pdr.calc_profit(ctx['MHW'], 5.0, cube, save = False)
+    return f, {'layers':cube.shape[0]}
+
+def case_calc_eu_series(ctx):
+    pdr = ctx['polder']
+    f = lambda: pdr.calc_eu_series(ctx['MHW'], 5.0, ctx['MW'], 1.0, ctx['horizon'], save = False)
+    return f, {'horizon':ctx['horizon']}
+
+# household.utility one household at a time, for up to 1000 of them.
+
+def case_household_utility(ctx):
+    pdr = ctx['polder']
+    profit = pdr.calc_profit(ctx['MHW'], 5.0, pdr.elevation_cube[:(ctx['horizon'] + 1)], save = False)
+    sample = list(pdr.households.values())[:1000]
+    def f():
+        for hh in sample:
+            hh.utility(profit)
+    return f, {'calls':len(sample)}
+
+def plots_case(ctx, method):
+    spec = ctx['spec']
+    alpha = (1.0 / 0.3 + 1.0) / 2.0
+    weights = np.random.RandomState(ctx['seed']).pareto(alpha, size = spec['n_households'])
+    pdr = polder(x = spec['x'], y = spec['y'], time_horizon = 0, seed = ctx['seed'])
+    return lambda: pdr.build_plots(weights, method = method), {'method':method}
+
+def case_build_plots_split(ctx):
+    return plots_case(ctx, 'split')
+
+def case_build_plots_squarify(ctx):
+    return plots_case(ctx, 'squarify')
+
+def case_instant_runoff(ctx):
+    ballots = ctx['preferences'].ballots
+    return lambda: instant_runoff(ballots), {'years':ballots.shape[1]}
+
+def case_auction(ctx):
+    pdr, prefs = ctx['polder'], ctx['preferences']
+    info = dict()
+    def f():
+        wealth = [ (hh, hh.wealth) for hh in pdr.households.values() ]
+        try:
+            a = auction(pdr.households, prefs, seed = ctx['seed'], verbose = False)
+            a.auction()
+        finally:
+            for hh, w in wealth:
+                hh.wealth = w
+        rows = a.ledger.rows
+        info['transactions'] = len(a.ledger)
+        info['rounds'] = int(rows['round'].max()) + 1 if rows.size > 0 else 0
+    return f, info
+
+# The first bidding round of an auction, on the bids of its first target.
+
+def case_bidding_round(ctx):
+    a = auction(ctx['polder'].households, ctx['preferences'], seed = ctx['seed'], verbose = False)
+    a.initialize_votes()
+    target = a.vote(force = True)
+    bids = a.construct_bids(target, a.ledger.neutral(), a.ledger.first_purchase)
+    def f():
+        a.rng = np.random.RandomState(ctx['seed'])
+        a.bidding_round(bids)
+    return f, {'bids':len(bids)}
+
+# The point model of sed_mod over a week of the synthetic tides, with a
+# constant weekly SSC. run_model reads the SSC from the module global
+# ssc_by_week, which is set for each call and put back afterwards. sed_mod
+# needs feather and tqdm, so the case is skipped where they are missing.
+
+def case_sed_mod_run_model(ctx):
+    import sed_mod
+    tides = ctx['tides'][:(7 * 24 + 1)].to_frame()
+    ssc = pd.DataFrame({'ssc':np.full(53, ctx['SSC'])}, index = np.arange(1, 54))
+    def f():
+        had = hasattr(sed_mod, 'ssc_by_week')
+        saved = getattr(sed_mod, 'ssc_by_week', None)
+        sed_mod.ssc_by_week = ssc
+        try:
+            sed_mod.run_model(tides, 0.03, ctx['rho'], 0, 0, 0, 1.0, 0.0)
+        finally:
+            if had:
+                sed_mod.ssc_by_week = saved
+            else:
+                del sed_mod.ssc_by_week
+    return f, {'steps':len(tides) - 1}
+
+# Name -> (case, scales it runs at).
+
+cases = {'aggrade_patches':(case_aggrade_patches, None),
+         'polder.aggrade':(case_polder_aggrade, None),
+         'calc_profit':(case_calc_profit, None),
+         'calc_eu_series':(case_calc_eu_series, None),
+         'household.utility':(case_household_utility, None),
+         'build_plots.split':(case_build_plots_split, None),
+         'build_plots.squarify':(case_build_plots_squarify, None),
+         'instant_runoff':(case_instant_runoff, None),
+         'auction':(case_auction, None),
+         'bidding_round':(case_bidding_round, None),
+         'sed_mod.run_model':(case_sed_mod_run_model, ('small',))}
+
+# The commit the code was run at (with dirty = True if the working tree
+# has changes) and the machine it ran on.
+
+def environment():
+    here = os.path.dirname(os.path.abspath(__file__))
+    def git(*args):
+        try:
+            return subprocess.check_output(('git',) + args, cwd = here, stderr = subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {'commit':git('rev-parse', 'HEAD'), 'dirty':None if status is None else len(status) > 0,
+            'date':datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'python':platform.python_version(), 'numpy':np.__version__, 'pandas':pd.__version__,
+            'platform':platform.platform(), 'processor':platform.processor(), 'cpu_count':os.cpu_count()}
+
+# Run the cases (all by default) at the given scales, repeat times each,
+# and write the results, with environment(), as JSON to path (by default
+# bench_<commit>.json). Returns the results as a DataFrame.
+
+def run_suite(scale_names = ('small', 'medium', 'large'), case_names = None, repeat = 3, path = None, seed = 0):
+    env = environment()
+    if case_names is None:
+        case_names = list(cases.keys())
+    results = []
+    for scale in scale_names:
+        ctx = scale_context(scale, seed)
+        spec = scales[scale]
+        for name in case_names:
+            case, only = cases[name]
+            if only is not None and scale not in only:
+                continue
+            row = {'case':name, 'scale':scale, 'n_households':spec['n_households'], 'x':spec['x'], 'y':spec['y']}
+            try:
+                f, info = case(ctx)
+            except ImportError as e:
+                row['skipped'] = str(e)
+                results.append(row)
+                print("%-22s %-6s skipped: %s" % (name, scale, e))
+                continue
+            times = run_times(f, repeat)
+            row.update({'best':min(times), 'median':float(np.median(times)), 'times':times, 'info':info})
+            results.append(row)
+            print("%-22s %-6s best %9.4f s, median %9.4f s" % (name, scale, row['best'], row['median']))
+        del ctx
+    if path is None:
+        path = 'bench_%s.json' % (env['commit'][:10] if env['commit'] else 'unknown')
+    with open(path, 'w') as f:
+        json.dump({'environment':env, 'repeat':repeat, 'seed':seed, 'results':results}, f, indent = 1,
+                  default = trm.to_builtin)
+    print("Results written to", path)
+    return pd.DataFrame(results)
+
+def load_results(path):
+    with open(path) as f:
+        record = json.load(f)
+    table = pd.DataFrame(record['results'])
+    if 'best' not in table:
+        table['best'] = np.nan
+    return record['environment'], table.set_index(['case', 'scale'])
+
+# Best times of two suite runs side by side: ratio = new / base, and a
+# case is a regression (improvement) when it is more than threshold
+# slower (faster) than the base.
+
+def compare(base_path, new_path, threshold = 0.1):
+    base_env, base = load_results(base_path)
+    new_env, new = load_results(new_path)
+    table = pd.DataFrame({'base':base['best'], 'new':new['best']}).dropna()
+    table['ratio'] = table['new'] / table['base']
+    table['change'] = np.where(table['ratio'] > 1.0 + threshold, 'regression',
+                               np.where(table['ratio'] < 1.0 / (1.0 + threshold), 'improvement', ''))
+    print("base", base_env['commit'], "new", new_env['commit'])
+    print(table.to_string(float_format = lambda v: '%.4f' % v))
+    return table
+
+#%% Run benchmarks
+# python benchmarks.py [small|medium|large ...]   run the suite
+# python benchmarks.py compare base.json new.json compare two runs
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        compare(sys.argv[2], sys.argv[3])
+    else:
+        run_suite(tuple(sys.argv[1:]) if len(sys.argv) > 1 else ('small', 'medium', 'large'))
@@ -0,0 +1,273 @@
+#%% Import packages
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+from trm import auction, preferences, polder
+import decision
+from welfare import gini
+
+#%% Define classes
+
+# Running totals over auction replicates: how often each year wins, a
+# histogram and moments of the transaction prices, the distribution of the
+# number of unhappy households and of the lowest utility, and how often each
+# household ends up unhappy. Replicates are added one at a time, so nothing
+# grows with the number of replicates.
+
+class auction_stats(object):
+    def __init__(self, n_households, n_years, price_bins):
+        self.n = 0
+        self.wins = np.zeros(n_years, np.int64)
+        self.price_bins = np.asarray(price_bins, np.double)
+        self.price_hist = np.zeros(self.price_bins.size + 1, np.int64)
+        self.n_trades = 0
+        self.price_sum = 0.0
+        self.price_sumsq = 0.0
+        self.price_min = np.inf
+        self.price_max = - np.inf
+        self.trades = np.zeros(0, np.int64)
+        self.rounds = np.zeros(0, np.int64)
+        self.unhappy = np.zeros(n_households + 1, np.int64)
+        self.hh_unhappy = np.zeros(n_households, np.int64)
+        self.utility_sum = 0.0
+        self.utility_sumsq = 0.0
+        self.utility_min = np.inf
+        self.utility_max = - np.inf
+
+    def add(self, result):
+        winner, prices, n_rounds, unhappy, min_utility = result
+        self.n += 1
+        self.wins[winner] += 1
+        self.price_hist += np.bincount(np.searchsorted(self.price_bins, prices, side = 'right'),
+                                       minlength = self.price_hist.size)
+        if prices.size > 0:
+            self.n_trades += prices.size
+            self.price_sum += prices.sum()
+            self.price_sumsq += np.dot(prices, prices)
+            self.price_min = min(self.price_min, prices.min())
+            self.price_max = max(self.price_max, prices.max())
+        self.trades = add_count(self.trades, prices.size)
+        self.rounds = add_count(self.rounds, n_rounds)
+        self.unhappy[np.count_nonzero(unhappy)] += 1
+        self.hh_unhappy += unhappy
+        self.utility_sum += min_utility
+        self.utility_sumsq += min_utility ** 2
+        self.utility_min = min(self.utility_min, min_utility)
+        self.utility_max = max(self.utility_max, min_utility)
+
+    def winner_frequency(self):
+        return pd.Series(self.wins / float(max(self.n, 1)))
+
+    def price_summary(self):
+        n = max(self.n_trades, 1)
+        mean = self.price_sum / n
+        return {'count':self.n_trades, 'mean':mean, 'std':np.sqrt(max(self.price_sumsq / n - mean ** 2, 0.0)),
+                'min':self.price_min, 'max':self.price_max}
+
+    def unhappy_summary(self):
+        counts = np.arange(self.unhappy.size)
+        n = max(self.n, 1)
+        return {'mean':np.dot(counts, self.unhappy) / float(n),
+                'min':int(counts[self.unhappy > 0].min()) if self.n > 0 else 0,
+                'max':int(counts[self.unhappy > 0].max()) if self.n > 0 else 0,
+                'min_utility':self.utility_sum / self.n if self.n > 0 else np.nan}
+
+    # Moments of the lowest utility of each replicate.
+
+    def utility_summary(self):
+        n = max(self.n, 1)
+        mean = self.utility_sum / n
+        return {'count':self.n, 'mean':mean if self.n > 0 else np.nan,
+                'std':np.sqrt(max(self.utility_sumsq / n - mean ** 2, 0.0)) if self.n > 0 else np.nan,
+                'min':self.utility_min, 'max':self.utility_max}
+
+# Running summary of per-realization results (dicts of scalars, as
+# returned by run_realization): count, mean, variance (Welford), minimum
+# and maximum of every numeric entry and how often each year wins under
+# each rule. Only these totals are kept, unless keep_rows is set.
+
+class realization_stats(object):
+    def __init__(self, keep_rows = False):
+        self.n = 0
+        self.mean = dict()
+        self.m2 = dict()
+        self.min = dict()
+        self.max = dict()
+        self.wins = dict()
+        self.rows = [] if keep_rows else None
+
+    def add(self, summary):
+        self.n += 1
+        for key, value in summary.items():
+            if key.endswith('_winner'):
+                rule = key[:-len('_winner')]
+                counts = self.wins.setdefault(rule, np.zeros(0, np.int64))
+                self.wins[rule] = add_count(counts, int(value))
+                continue
+            if key == 'realization':
+                continue
+            value = float(value)
+            if key not in self.mean:
+                self.mean[key], self.m2[key], self.min[key], self.max[key] = 0.0, 0.0, value, value
+            delta = value - self.mean[key]
+            self.mean[key] += delta / self.n
+            self.m2[key] += delta * (value - self.mean[key])
+            self.min[key] = min(self.min[key], value)
+            self.max[key] = max(self.max[key], value)
+        if self.rows is not None:
+            self.rows.append(summary)
+
+    def summary(self):
+        keys = list(self.mean.keys())
+        std = [ np.sqrt(self.m2[k] / (self.n - 1)) if self.n > 1 else np.nan for k in keys ]
+        return pd.DataFrame({'mean':[ self.mean[k] for k in keys ], 'std':std,
+                             'min':[ self.min[k] for k in keys ], 'max':[ self.max[k] for k in keys ]},
+                            index = keys)
+
+    def winner_frequency(self):
+        n_years = max([ c.size for c in self.wins.values() ] + [0])
+        return pd.DataFrame(dict((rule, np.pad(c, (0, n_years - c.size)) / float(max(self.n, 1)))
+                                 for rule, c in self.wins.items())).rename_axis('year')
+
+#%% Define functions
+
+# Inherited by the forked workers, so that the households and preferences
+# are not pickled for every replicate.
+
+_auction_state = dict()
+
+# One auction with its own RNG stream. The households' wealth is restored
+# afterwards, so replicates run in the same process do not see each other.
+
+def run_replicate(seed_seq):
+    hh_dict = _auction_state['households']
+    prefs = _auction_state['preferences']
+    wealth = [ (hh, hh.wealth) for hh in hh_dict.values() ]
+    rng = np.random.RandomState(np.random.MT19937(seed_seq))
+    a = auction(hh_dict, prefs, seed = rng, verbose = False)
+    try:
+        winner, u = a.auction(_auction_state['max_rounds'])
+    finally:
+        for hh, w in wealth:
+            hh.wealth = w
+    rows = a.ledger.rows
+    n_rounds = int(rows['round'].max()) + 1 if rows.size > 0 else 0
+    return (int(winner), np.array(rows['price']), n_rounds, a.unhappy_mask(winner),
+            a.utility_array(winner).min())
+
+# Run n_replicates auctions over the same preferences, each seeded from its
+# own child of SeedSequence(seed), in a forked pool of n_workers processes
+# (or in this process for n_workers = 1). Results are folded into an
+# auction_stats as they arrive, in replicate order, so the outcome depends
+# on the seed only and not on the number of workers.
+
+def run_auctions(hh_dict, n_replicates, seed = 0, n_workers = 1, prefs = None, max_rounds = 1000,
+                 price_bins = None, chunk_size = 4):
+    if prefs is None:
+        prefs = preferences.from_households(hh_dict)
+    if price_bins is None:
+        price_bins = np.linspace(0.0, 1.1 * (prefs.best[:,np.newaxis] - prefs.eu).max(), 51)
+    stats = auction_stats(prefs.n_households, prefs.n_years, price_bins)
+    seeds = np.random.SeedSequence(seed).spawn(n_replicates)
+    _auction_state['households'] = hh_dict
+    _auction_state['preferences'] = prefs
+    _auction_state['max_rounds'] = max_rounds
+    try:
+        if n_workers > 1:
+            with mp.get_context('fork').Pool(n_workers) as pool:
+                for result in pool.imap(run_replicate, seeds, chunk_size):
+                    stats.add(result)
+        else:
+            for s in seeds:
+                stats.add(run_replicate(s))
+    finally:
+        _auction_state.clear()
+    return stats
+
+def add_count(counts, k):
+    if k >= counts.size:
+        counts = np.concatenate((counts, np.zeros(k + 1 - counts.size, counts.dtype)))
+    counts[k] += 1
+    return counts
+
+# Settings of run_realizations, inherited by the forked workers.
+
+_realization_state = dict()
+
+# One polder realization: elevation noise and parcels drawn from the first
+# child of seed_seq, aggradation over the horizon (if tides are given;
+# otherwise the land keeps its initial elevation throughout),
+# the EU series and every decision rule, the auction drawing from the
+# second child. Returns a dict of scalars.
+
+def run_realization(task):
+    i, seed_seq = task
+    cfg = _realization_state
+    layout_seed, market_seed = seed_seq.spawn(2)
+    horizon = cfg['horizon']
+    pdr = polder(time_horizon = horizon, seed = np.random.MT19937(layout_seed), **cfg['polder_args'])
+    pdr.add_breach(cfg['breach'][0], cfg['breach'][1], horizon)
+    heads = cfg['heads']
+    if heads is not None:
+        for period in range(1, horizon):
+            pdr.aggrade(heads, period = period, **cfg['aggrade_args'])
+    else:
+        pdr.elevation_cube[1:horizon] = pdr.elevation_cube[0]
+    for hh in pdr.households.values():
+        hh.discount = cfg['discount']
+    trm_water_level, trm_k, wl_water_level, wl_k = cfg['eu_args']
+    pdr.calc_eu_series(trm_water_level, trm_k, wl_water_level, wl_k, horizon, save = False, n_workers = 1)
+    prefs = pdr.preferences
+    wealth = np.array([ hh.wealth for hh in pdr.households.values() ])
+    summary = {'realization':i, 'mean_elevation':pdr.elevation.mean(),
+               'mean_aggradation':(pdr.elevation_cube[horizon - 1] - pdr.elevation_cube[0]).mean(),
+               'wealth_gini':float(gini(wealth)), 'best_year_share':np.mean(prefs.favorite > 0)}
+    for name in cfg['rules']:
+        if name == 'auction':
+            rule = decision.auction(pdr.households, prefs)
+            rule.market.rng = np.random.RandomState(np.random.MT19937(market_seed))
+            rule.market.verbose = False
+            winner = rule.decide()[0]
+            u = rule.market.utility_array(winner)
+            summary['auction_transactions'] = len(rule.market.ledger)
+        else:
+            rule = decision.rules[name]({}, prefs)
+            winner = rule.winner()
+            u = prefs.utility(winner)
+        summary[name + '_winner'] = winner
+        summary[name + '_min_utility'] = u.min()
+        summary[name + '_unhappy'] = rule.count_unhappy(winner)
+    return summary
+
+# Build and simulate n_realizations polders, realization i seeded from
+# child i of SeedSequence(seed), in a forked pool of n_workers processes
+# (all cores by default). polder_args go to the polder constructor
+# (size, households, wealth, terrain); heads and aggrade_args (ws, rho,
+# SSC, dP, dO) drive polder.aggrade, and eu_args are the water levels and
+# steepness of calc_eu_series. Summaries are folded into a
+# realization_stats in realization order as they arrive.
+
+def run_realizations(n_realizations, polder_args, horizon, eu_args, heads = None, aggrade_args = None,
+                     breach = None, discount = 0.15, rules = ('irv', 'plurality', 'borda', 'auction'),
+                     seed = 0, n_workers = None, keep_rows = False, chunk_size = 1):
+    if n_workers is None:
+        n_workers = mp.cpu_count()
+    if breach is None:
+        breach = (0, polder_args['y'] / 2)
+    stats = realization_stats(keep_rows)
+    tasks = list(enumerate(np.random.SeedSequence(seed).spawn(n_realizations)))
+    _realization_state.update({'polder_args':polder_args, 'horizon':horizon, 'eu_args':eu_args,
+                               'heads':heads, 'aggrade_args':aggrade_args or {}, 'breach':breach,
+                               'discount':discount, 'rules':rules})
+    try:
+        if n_workers > 1:
+            with mp.get_context('fork').Pool(n_workers) as pool:
+                for summary in pool.imap(run_realization, tasks, chunk_size):
+                    stats.add(summary)
+        else:
+            for t in tasks:
+                stats.add(run_realization(t))
+    finally:
+        _realization_state.clear()
+    return stats
@@ -0,0 +1,111 @@
+#%% Import packages
+import os
+import json
+import numpy as np
+
+from trm import polder
+
+#%% Define classes
+
+# A catalogue of generated polder layouts: the initial elevation surface,
+# the parcel table and the breach of one realization, stored under
+# path/<layout id>/ as .npy files that np.load can memory-map, with the
+# parameters and seed of every layout in path/catalogue.json. Loading a
+# layout maps its files read-only, so any number of processes can share one
+# copy through the page cache instead of regenerating it or unpickling
+# rasters. Plots are stored as int32; the owners raster is not stored, as
+# it follows from the plots (rasterize_plots) and the polder paints it.
+
+class catalogue(object):
+    index_file = 'catalogue.json'
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        index_path = os.path.join(path, self.index_file)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.layouts = json.load(f)
+        else:
+            self.layouts = dict()
+
+    def ids(self):
+        return sorted(self.layouts.keys())
+
+    def meta(self, layout_id):
+        return self.layouts[layout_id]
+
+    def find(self, **params):
+        return [ k for k in self.ids() if all(self.layouts[k].get(p) == v for p, v in params.items()) ]
+
+    def save_index(self):
+        index_path = os.path.join(self.path, self.index_file)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self.layouts, f, indent = 1, sort_keys = True)
+        os.replace(index_path + '.tmp', index_path)
+
+    # Store the current layout of a polder (elevation and plots before any
+    # aggradation) with its breach and whatever parameters are given as
+    # metadata. Returns the id of the layout.
+
+    def add(self, pdr, layout_id = None, breach = None, **meta):
+        if layout_id is None:
+            layout_id = 'layout_%05d' % len(self.layouts)
+        if breach is None and len(pdr.breaches) > 0:
+            breach = (pdr.breaches[0].x, pdr.breaches[0].y)
+        folder = os.path.join(self.path, layout_id)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        plots = pdr.hh_plot_table()
+        n_households = len(pdr.households)
+        np.save(os.path.join(folder, 'elevation.npy'), pdr.elevation_cube[0])
+        np.save(os.path.join(folder, 'plots.npy'), plots.astype(np.int32))
+        meta = dict(meta)
+        meta.update({'x':int(pdr.width), 'y':int(pdr.height), 'n_households':int(n_households),
+                     'border_height':float(pdr.border_height), 'max_wealth':float(pdr.max_wealth),
+                     'max_profit':float(pdr.max_profit),
+                     'breach':None if breach is None else [ float(b) for b in breach ]})
+        self.layouts[layout_id] = meta
+        self.save_index()
+        return layout_id
+
+    # Generate n layouts with seeds seed, seed + 1, ... and add them to the
+    # catalogue. Keyword arguments go to the polder constructor and are
+    # kept in the metadata, so that every layout can be regenerated.
+
+    def generate(self, n, x, y, n_households, seed = 0, breach = None, plot_method = 'split', **kwargs):
+        if breach is None:
+            breach = (0, y / 2)
+        ids = []
+        for s in range(seed, seed + n):
+            pdr = polder(x = x, y = y, time_horizon = 0, n_households = n_households,
+                         plot_method = plot_method, seed = s, **kwargs)
+            ids.append(self.add(pdr, breach = breach, seed = s, plot_method = plot_method, **kwargs))
+        return ids
+
+    # Arrays of a layout, memory-mapped read-only unless mmap_mode is None.
+
+    def load(self, layout_id, mmap_mode = 'r'):
+        folder = os.path.join(self.path, layout_id)
+        return dict((name, np.load(os.path.join(folder, name + '.npy'), mmap_mode = mmap_mode))
+                    for name in ('elevation', 'plots'))
+
+    # A polder on a stored layout, with one household per owner id and the
+    # layout's breach open for the given duration. The elevation is taken
+    # from the memory-mapped file; the polder only copies it into its cube.
+
+    def polder(self, layout_id, time_horizon, breach_duration = None, **kwargs):
+        meta = self.layouts[layout_id]
+        arrays = self.load(layout_id)
+        for p in ('border_height', 'max_wealth', 'max_profit'):
+            kwargs.setdefault(p, meta[p])
+        pdr = polder(x = meta['x'], y = meta['y'], time_horizon = time_horizon, amplitude = 0.0, noise = 0.0,
+                     **kwargs)
+        pdr.set_elevation(arrays['elevation'], np.array(arrays['plots'], dtype = pdr.plots.dtype),
+                          meta['n_households'])
+        if meta['breach'] is not None:
+            if breach_duration is None:
+                breach_duration = time_horizon
+            pdr.add_breach(meta['breach'][0], meta['breach'][1], breach_duration)
+        return pdr
@@ -0,0 +1,245 @@
+#%% Import packages
+import os
+import json
+import hashlib
+import datetime
+import numpy as np
+import pandas as pd
+from scipy.signal import argrelextrema
+
+import trm
+from trm import polder, preferences, load_tides
+import decision
+import artifact
+from artifact import write_artifact
+
+#%% Define classes
+
+# Results of pipeline stages on disk, one folder per result, named by a
+# hash of the stage, its parameters, the keys of the results it was
+# computed from and the source of the model code. A result is only reused
+# when all of these match, so changing a parameter reruns the stages that
+# depend on it and nothing upstream, and editing trm.py or this file
+# invalidates everything.
+
+class stage_cache(object):
+    def __init__(self, path = 'cache'):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.code = code_hash()
+        self.hits = []
+        self.misses = []
+
+    def key(self, stage, params, inputs = ()):
+        spec = {'stage':stage, 'params':params, 'inputs':list(inputs), 'code':self.code}
+        text = json.dumps(spec, sort_keys = True, default = to_json)
+        return stage + '_' + hashlib.sha256(text.encode('utf-8')).hexdigest()[:24]
+
+    # Load the result for key, or compute it (a dict of arrays) and store it
+    # as a run artifact, which write_artifact writes under a temporary name
+    # and renames, so a run that is interrupted never leaves a partial
+    # result behind. Cached arrays come back memory-mapped and read-only.
+
+    def get(self, key, compute, params = None):
+        folder = os.path.join(self.path, key)
+        data_file = os.path.join(folder, 'data.trm')
+        if os.path.exists(data_file):
+            self.hits.append(key)
+            art = artifact.artifact(data_file)
+            return dict((name, art.read(name, upcast = True)) for name in art.names())
+        self.misses.append(key)
+        result = compute()
+        os.makedirs(folder, exist_ok = True)
+        with open(os.path.join(folder, 'params.json'), 'w') as f:
+            json.dump(params, f, indent = 1, sort_keys = True, default = to_json)
+        write_artifact(data_file, result, meta = {'key':key})
+        return result
+
+# The model as explicit stages, tides -> layout -> aggrade -> hh_profit
+# (TRM and waterlogging) -> eu -> decision, each cached under the hash of
+# its own parameters and its inputs' keys. Parameters are the defaults of
+# test() unless overridden, either in the constructor or per call.
+
+class pipeline(object):
+    defaults = {
+        # tides
+        'tide_file':os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'p32_tides.dat'),
+        'tide_start':'2015-05-15 01:00', 'tide_end':'2016-05-14 01:00', 'tide_offset':0.25,
+        # layout
+        'x':500, 'y':300, 'n_households':100, 'max_wealth':1.0E4, 'max_profit':100.,
+        'border_height':0.5, 'amplitude':1.5, 'noise':0.05, 'gini':0.3, 'plot_method':'squarify',
+        'seed':0, 'breach_x':0, 'breach_y':150,
+        # aggradation
+        'time_horizon':10, 'grain_size':0.03, 'rho':1100, 'SSC':0.2, 'dP':0, 'dO':0,
+        # profit and EU
+        'horizon':4, 'trm_k':5.0, 'wl_k':1.0, 'discount':0.15,
+        # decision
+        'rule':'irv', 'auction_seed':0,
+    }
+
+    def __init__(self, cache_dir = 'cache', **params):
+        self.cache = stage_cache(cache_dir)
+        self.params = dict(self.defaults)
+        self.params.update(params)
+
+    def with_params(self, params):
+        p = dict(self.params)
+        p.update(params)
+        return p
+
+    def stage(self, name, p, names, inputs, compute):
+        params = dict((k, p[k]) for k in names)
+        key = self.cache.key(name, params, inputs)
+        return (key, self.cache.get(key, compute, params))
+
+    def tides(self, **params):
+        p = self.with_params(params)
+        names = ('tide_file', 'tide_start', 'tide_end', 'tide_offset')
+        def compute():
+            parser = lambda x: datetime.datetime.strptime(x, '%d-%b-%Y %H:%M:%S')
+            tides = load_tides(p['tide_file'], parser, pd.Timestamp(p['tide_start']),
+                               pd.Timestamp(p['tide_end'])) + p['tide_offset']
+            pressure = tides.values
+            return {'time':tides.index.values.astype(np.int64), 'level':pressure,
+                    'MW':np.mean(pressure),
+                    'MHW':np.mean(pressure[argrelextrema(pressure, np.greater)[0]]),
+                    'MLW':np.mean(pressure[argrelextrema(pressure, np.less)[0]])}
+        # the tide file's contents are part of the key
+        inputs = (file_hash(p['tide_file']),)
+        return self.stage('tides', p, names, inputs, compute)
+
+    def layout(self, **params):
+        p = self.with_params(params)
+        names = ('x', 'y', 'n_households', 'border_height', 'amplitude', 'noise', 'gini',
+                 'plot_method', 'seed')
+        def compute():
+            pdr = polder(x = p['x'], y = p['y'], time_horizon = 0, n_households = p['n_households'],
+                         border_height = p['border_height'], amplitude = p['amplitude'], noise = p['noise'],
+                         gini = p['gini'], plot_method = p['plot_method'], seed = p['seed'])
+            return {'elevation':pdr.elevation, 'plots':pdr.hh_plot_table()}
+        return self.stage('layout', p, names, (), compute)
+
+    # A polder on the cached layout, with the breach open and, if given, an
+    # elevation cube in place of the flat one.
+
+    def polder(self, elevation_cube = None, **params):
+        p = self.with_params(params)
+        key, layout = self.layout(**params)
+        pdr = polder(x = p['x'], y = p['y'], time_horizon = p['time_horizon'], max_wealth = p['max_wealth'],
+                     max_profit = p['max_profit'], border_height = p['border_height'],
+                     amplitude = 0.0, noise = 0.0)
+        pdr.set_elevation(layout['elevation'], layout['plots'], p['n_households'])
+        pdr.add_breach(p['breach_x'], p['breach_y'], p['time_horizon'])
+        if elevation_cube is not None:
+            pdr.elevation_cube = np.array(elevation_cube)
+        return pdr
+
+    def aggrade(self, **params):
+        p = self.with_params(params)
+        names = ('time_horizon', 'grain_size', 'rho', 'SSC', 'dP', 'dO', 'breach_x', 'breach_y',
+                 'border_height')
+        tides_key, tides = self.tides(**params)
+        layout_key, layout = self.layout(**params)
+        def compute():
+            pdr = self.polder(**params)
+            heads = pd.Series(tides['level'], index = pd.to_datetime(tides['time']))
+            ws = ((p['grain_size'] / 1000) ** 2 * 1650 * 9.8) / 0.018
+            for i in range(pdr.time_horizon):
+                pdr.aggrade(heads, ws, p['rho'], p['SSC'], p['dP'], p['dO'], i + 1)
+            return {'elevation_cube':pdr.elevation_cube}
+        return self.stage('aggrade', p, names, (tides_key, layout_key), compute)
+
+    # Per-household profit of every layer up to the horizon, under TRM (at
+    # mean high water, steepness trm_k) or waterlogging (mean water, wl_k).
+
+    def hh_profit(self, regime, **params):
+        p = self.with_params(params)
+        k_name = {'trm':'trm_k', 'wl':'wl_k'}[regime]
+        names = ('horizon', k_name, 'max_profit')
+        tides_key, tides = self.tides(**params)
+        cube_key, cube = self.aggrade(**params)
+        def compute():
+            pdr = self.polder(**params)
+            water_level = tides['MHW'] if regime == 'trm' else tides['MW']
+            ec = cube['elevation_cube'][:p['horizon']]
+            return {'hh_profit':pdr.calc_hh_profit(float(water_level), p[k_name], ec)}
+        return self.stage('hh_profit_' + regime, p, names, (tides_key, cube_key), compute)
+
+    def eu(self, **params):
+        p = self.with_params(params)
+        names = ('horizon', 'discount')
+        trm_key, trm_hh = self.hh_profit('trm', **params)
+        wl_key, wl_hh = self.hh_profit('wl', **params)
+        def compute():
+            pdr = self.polder(**params)
+            discount = np.broadcast_to(p['discount'], len(pdr.households))
+            for hh, d in zip(pdr.households.values(), discount):
+                hh.discount = d
+            eu = pdr.eu_from_hh_profit(trm_hh['hh_profit'], wl_hh['hh_profit'], p['horizon'])
+            return {'ids':pdr.hh_ids(), 'hh_eu':eu}
+        return self.stage('eu', p, names, (trm_key, wl_key), compute)
+
+    # The winner of one decision rule (a name in decision.rules) on the
+    # cached EU, with every household's utility of it and whether it is
+    # unhappy; for the auction also the net transfers.
+
+    def decide(self, **params):
+        p = self.with_params(params)
+        names = ('rule', 'auction_seed', 'max_wealth') if p['rule'] == 'auction' else ('rule',)
+        eu_key, eu = self.eu(**params)
+        def compute():
+            prefs = preferences(eu['ids'], eu['hh_eu'].T)
+            if p['rule'] == 'auction':
+                pdr = self.polder(**params)
+                rule = decision.auction(pdr.households, prefs)
+                rule.market.rng = np.random.RandomState(p['auction_seed'])
+                rule.market.verbose = False
+                winner = rule.decide()[0]
+                result = {'net':rule.market.ledger.net, 'utility':rule.market.utility_array(winner),
+                          'unhappy':rule.market.unhappy_mask(winner)}
+            else:
+                rule = decision.rules[p['rule']]({}, prefs)
+                winner = rule.winner()
+                result = {'utility':prefs.utility(winner), 'unhappy':prefs.unhappy(winner)}
+            result['winner'] = winner
+            return result
+        return self.stage('decision', p, names, (eu_key,), compute)
+
+    def run(self, **params):
+        key, result = self.decide(**params)
+        return result
+
+#%% Define functions
+
+def code_hash():
+    h = hashlib.sha256()
+    for module in (trm, decision, artifact):
+        h.update(file_hash(module.__file__).encode('utf-8'))
+    h.update(file_hash(os.path.abspath(__file__)).encode('utf-8'))
+    return h.hexdigest()
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Parameters may be numpy scalars or arrays (for instance a discount rate
+# per household); arrays are keyed by their dtype, shape and contents.
+
+def to_json(x):
+    if isinstance(x, np.ndarray):
+        return {'dtype':x.dtype.str, 'shape':x.shape, 'sha256':hashlib.sha256(np.ascontiguousarray(x)).hexdigest()}
+    if isinstance(x, np.generic):
+        return x.item()
+    raise TypeError("Cannot key parameter %r" % (x,))
+
+#%% Run program
+if __name__ == '__main__':
+    pipe = pipeline()
+    for rule in ('irv', 'auction'):
+        result = pipe.run(rule = rule)
+        print(rule, "winner = ", result['winner'], " min utility = ", result['utility'].min(), ", ",
+              np.count_nonzero(result['unhappy']), " unhappy households")
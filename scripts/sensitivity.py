@@ -0,0 +1,289 @@
+#%% Import packages
+import os
+import io
+import csv
+import json
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+
+from pipeline import pipeline, to_json
+from artifact import artifact, write_artifact
+
+#%% Define classes
+
+# A sensitivity study of the pipeline: a design over parameters (name,
+# low, high) of pipeline.defaults, a folder holding the design and the
+# results so far, and the pipeline cache the evaluations share. The design
+# is generated once and stored; reopening the folder with the same
+# settings picks up where the last run stopped, and other settings are
+# refused. Parameters not in the design are the pipeline's defaults or
+# fixed (say a shorter tide record or a smaller polder).
+#
+#   method = 'morris'   n trajectories of levels-level elementary effects
+#   method = 'sobol'    Saltelli design of n base points, (k + 2) n runs
+
+class study(object):
+    def __init__(self, path, method = 'sobol', n = 64, parameters = None, levels = 4, seed = 0,
+                 rules = ('irv',), cache_dir = None, **fixed):
+        if parameters is None:
+            parameters = default_parameters
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+        self.method = method
+        self.parameters = tuple(tuple(p) for p in parameters)
+        self.names = [ p[0] for p in self.parameters ]
+        self.rules = tuple(rules)
+        self.pipe = pipeline(cache_dir if cache_dir is not None else os.path.join(path, 'cache'), **fixed)
+        for name, lo, hi in self.parameters:
+            if name not in self.pipe.params:
+                raise ValueError("%s is not a pipeline parameter" % name)
+        horizon = dict((p[0], p[2]) for p in self.parameters).get('horizon', self.pipe.params['horizon'])
+        if horizon > self.pipe.params['time_horizon']:
+            raise ValueError("horizon up to %d needs time_horizon >= %d" % (horizon, horizon))
+        spec = json.loads(json.dumps({'method':method, 'n':n, 'parameters':self.parameters, 'levels':levels,
+                                      'seed':seed, 'rules':self.rules, 'fixed':fixed}, default = to_json))
+        design_file = os.path.join(path, 'design.trm')
+        if os.path.exists(design_file):
+            art = artifact(design_file)
+            if art.meta['spec'] != spec:
+                raise ValueError("%s holds a study with other settings" % path)
+            self.unit = art.read('unit', mmap = False)
+        else:
+            k = len(self.parameters)
+            if method == 'morris':
+                self.unit = morris_design(k, n, levels, seed)
+            elif method == 'sobol':
+                self.unit = saltelli_design(k, n, seed)
+            else:
+                raise ValueError("Unknown method %s" % method)
+            write_artifact(design_file, {'unit':self.unit}, meta = {'spec':spec})
+        self.results_file = os.path.join(path, 'results.csv')
+        self.columns = ['point'] + [ '%s_%s' % (rule, m) for rule in self.rules for m in outputs ]
+
+    def points(self):
+        return scale(self.unit, self.parameters)
+
+    def completed(self):
+        if not os.path.exists(self.results_file):
+            return set()
+        return set(self.results().index)
+
+    # Evaluate the points not in results.csv yet, in a forked pool of
+    # n_workers processes (all cores by default). The stages up to the
+    # aggradation are computed first, once for each distinct setting of
+    # their parameters, so that no two workers aggrade the same polder;
+    # the points then reuse them from the cache. Rows are appended to
+    # results.csv, in point order, as they come in.
+
+    def run(self, n_workers = None, chunk_size = 1):
+        if n_workers is None:
+            n_workers = mp.cpu_count()
+        trim_partial_row(self.results_file)
+        done = self.completed()
+        points = self.points()
+        todo = [ (i, to_params(row)) for i, row in zip(points.index, points.to_dict('records')) if i not in done ]
+        if len(todo) == 0:
+            return self.results()
+        upstream = [ name for name in self.names if name in aggrade_params ]
+        groups = dict()
+        for i, params in todo:
+            group = dict((name, params[name]) for name in upstream)
+            groups.setdefault(tuple(group[name] for name in upstream), group)
+        # the tides are the same for every point
+        self.pipe.tides()
+        _study_state.update({'pipeline':self.pipe, 'rules':self.rules})
+        new = not os.path.exists(self.results_file)
+        try:
+            with open(self.results_file, 'a', newline = '') as f:
+                writer = csv.writer(f)
+                if new:
+                    writer.writerow(self.columns)
+                    f.flush()
+                if n_workers > 1:
+                    with mp.get_context('fork').Pool(n_workers) as pool:
+                        pool.map(evaluate_upstream, list(groups.values()), 1)
+                        for row in pool.imap(evaluate_point, todo, chunk_size):
+                            writer.writerow(row)
+                            f.flush()
+                else:
+                    for group in groups.values():
+                        evaluate_upstream(group)
+                    for task in todo:
+                        writer.writerow(evaluate_point(task))
+                        f.flush()
+        finally:
+            _study_state.clear()
+        return self.results()
+
+    # One row per evaluated point, NaN outputs included; a point written
+    # twice (by runs that overlapped) keeps its first row, and a row left
+    # half-written by an interrupted run is ignored.
+
+    def results(self):
+        with open(self.results_file, 'rb') as f:
+            data = f.read()
+        table = pd.read_csv(io.BytesIO(data[:(data.rfind(b'\n') + 1)]))
+        table = table.drop_duplicates('point').astype({'point':int})
+        return table.set_index('point').sort_index()
+
+    # Indices of one output column (say 'irv_min_utility'): mu, mu_star and
+    # sigma of the elementary effects for Morris, S1 and ST with bootstrap
+    # confidence for Sobol.
+
+    def indices(self, output, n_boot = 100, seed = 0):
+        results = self.results()[output]
+        missing = np.setdiff1d(np.arange(self.unit.shape[0]), results.index)
+        if missing.size > 0:
+            raise ValueError("%d points have not been evaluated" % missing.size)
+        undefined = results.index[results.isna()]
+        if len(undefined) > 0:
+            raise ValueError("%s is NaN at points %s" % (output, list(undefined)))
+        y = results.values
+        if self.method == 'morris':
+            table = morris_indices(self.unit, y)
+        else:
+            table = sobol_indices(y, len(self.names), n_boot, seed)
+        table.index = self.names
+        return table
+
+#%% Define functions
+
+default_parameters = (('grain_size', 0.02, 0.06), ('rho', 1000.0, 1300.0), ('SSC', 0.1, 0.6),
+                      ('border_height', 0.25, 1.0), ('amplitude', 0.5, 2.5), ('trm_k', 1.0, 10.0),
+                      ('wl_k', 0.5, 2.0), ('discount', 0.05, 0.3), ('horizon', 2, 8))
+
+# Parameters that are rounded to integers, and those of the stages up to
+# and including the aggradation (pipeline.layout and pipeline.aggrade).
+
+integer_params = ('horizon', 'time_horizon', 'n_households', 'x', 'y', 'seed', 'breach_x', 'breach_y')
+aggrade_params = ('x', 'y', 'n_households', 'border_height', 'amplitude', 'noise', 'gini', 'plot_method',
+                  'seed', 'time_horizon', 'grain_size', 'rho', 'SSC', 'dP', 'dO', 'breach_x', 'breach_y')
+
+outputs = ('winner', 'min_utility', 'mean_utility', 'unhappy')
+
+# Map points of the unit hypercube to parameter values; integer parameters
+# take each of lo..hi on an equal share of [0, 1].
+
+def scale(unit, parameters):
+    unit = np.atleast_2d(unit)
+    columns = dict()
+    for j, (name, lo, hi) in enumerate(parameters):
+        if name in integer_params:
+            columns[name] = np.minimum(lo + np.floor(unit[:,j] * (hi - lo + 1)), hi).astype(int)
+        else:
+            columns[name] = lo + unit[:,j] * (hi - lo)
+    return pd.DataFrame(columns, columns = [ p[0] for p in parameters ]).rename_axis('point')
+
+def to_params(row):
+    return dict((name, int(v) if name in integer_params else float(v)) for name, v in row.items())
+
+# Morris trajectories: r random starting points on a levels-level grid,
+# each followed by one step of +-delta, delta = levels / (2 (levels - 1)),
+# in every dimension in random order. Returns the r (k + 1) points,
+# trajectory after trajectory.
+
+def morris_design(k, r, levels = 4, seed = None):
+    if levels % 2 != 0:
+        raise ValueError("levels must be even")
+    rng = np.random.RandomState(seed)
+    delta = levels / (2.0 * (levels - 1))
+    base = rng.randint(0, levels // 2, (r, k)) / (levels - 1.0)
+    sign = rng.choice((-1.0, 1.0), (r, k))
+    order = np.argsort(rng.random_sample((r, k)), axis = 1)
+    x = np.empty((r, k + 1, k))
+    x[:,0] = base + delta * (sign < 0)
+    rows = np.arange(r)
+    for s in range(k):
+        x[:,s + 1] = x[:,s]
+        j = order[:,s]
+        x[rows,s + 1,j] += sign[rows,j] * delta
+    return x.reshape(r * (k + 1), k)
+
+# Elementary effects (y change per unit step) of each dimension, from the
+# trajectories of morris_design and the outputs y at its points.
+
+def morris_indices(design, y):
+    k = design.shape[1]
+    x = design.reshape(-1, k + 1, k)
+    y = np.asarray(y, np.double).reshape(-1, k + 1)
+    dx = np.diff(x, axis = 1)
+    dim = np.abs(dx).argmax(axis = 2)
+    step = np.take_along_axis(dx, dim[:,:,np.newaxis], axis = 2)[:,:,0]
+    ee = np.empty_like(step)
+    np.put_along_axis(ee, dim, np.diff(y, axis = 1) / step, axis = 1)
+    return pd.DataFrame({'mu':ee.mean(axis = 0), 'mu_star':np.abs(ee).mean(axis = 0),
+                         'sigma':ee.std(axis = 0, ddof = 1) if ee.shape[0] > 1 else np.nan})
+
+# Saltelli's design: matrices A and B of n scrambled Sobol points each and,
+# for every dimension i, A with column i taken from B. Returns A, B, AB_1,
+# ..., AB_k stacked, (k + 2) n points; n should be a power of 2.
+
+def saltelli_design(k, n, seed = None):
+    base = qmc.Sobol(2 * k, scramble = True, seed = seed).random(n)
+    A, B = base[:,:k], base[:,k:]
+    AB = np.repeat(A[np.newaxis], k, axis = 0)
+    for i in range(k):
+        AB[i,:,i] = B[:,i]
+    return np.concatenate((A, B, AB.reshape(k * n, k)))
+
+# First-order (Saltelli 2010) and total (Jansen 1999) indices from the
+# outputs on saltelli_design,
+#   S1_i = mean(f(B) (f(AB_i) - f(A))) / V,  ST_i = mean((f(A) - f(AB_i))^2) / 2 V,
+# with V the variance of f over A and B, and the half-width of a 95%
+# interval from n_boot bootstrap resamples of the base points.
+
+def sobol_indices(y, k, n_boot = 100, seed = None):
+    y = np.asarray(y, np.double)
+    n = y.size // (k + 2)
+    fA, fB, fAB = y[:n], y[n:(2 * n)], y[(2 * n):].reshape(k, n)
+    def estimate(idx):
+        a, b, ab = fA[idx], fB[idx], fAB[:,idx]
+        var = np.var(np.concatenate((a, b), axis = -1), axis = -1)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            S1 = np.mean(b * (ab - a), axis = -1) / var
+            ST = 0.5 * np.mean((a - ab) ** 2, axis = -1) / var
+        return S1, ST
+    S1, ST = estimate(np.arange(n))
+    table = pd.DataFrame({'S1':S1, 'ST':ST})
+    if n_boot > 0:
+        idx = np.random.RandomState(seed).randint(0, n, (n_boot, n))
+        S1_boot, ST_boot = estimate(idx)
+        table['S1_conf'] = 1.96 * np.nanstd(S1_boot, axis = 1, ddof = 1)
+        table['ST_conf'] = 1.96 * np.nanstd(ST_boot, axis = 1, ddof = 1)
+    return table
+
+# Worker side of study.run; the pipeline is inherited from the parent.
+
+_study_state = dict()
+
+def evaluate_upstream(params):
+    _study_state['pipeline'].aggrade(**params)
+
+def evaluate_point(task):
+    i, params = task
+    row = [i]
+    for rule in _study_state['rules']:
+        result = _study_state['pipeline'].run(rule = rule, **params)
+        u = np.asarray(result['utility'])
+        row += [int(result['winner']), u.min(), u.mean(), int(np.count_nonzero(result['unhappy']))]
+    return row
+
+# Drop a row left half-written by an interrupted run.
+
+def trim_partial_row(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if len(data) > 0 and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+#%% Run program
+if __name__ == '__main__':
+    s = study('sensitivity', method = 'morris', n = 10, rules = ('irv', 'auction'))
+    s.run()
+    for output in ('irv_min_utility', 'auction_min_utility'):
+        print(output)
+        print(s.indices(output))
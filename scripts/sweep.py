@@ -0,0 +1,122 @@
+#%% Import packages
+import itertools
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+from trm import polder, election, auction
+
+#%% Define functions
+
+# State of a sweep worker: the shared-memory blocks it is attached to and
+# the polder built on them once, in the pool initializer.
+
+_sweep_state = dict()
+
+# Copy arrays into new shared-memory blocks. Returns the blocks and, for
+# each array, the (name, shape, dtype) needed to attach to it.
+
+def share_arrays(arrays):
+    blocks = dict()
+    specs = dict()
+    for name, a in arrays.items():
+        a = np.ascontiguousarray(a)
+        shm = shared_memory.SharedMemory(create = True, size = max(a.nbytes, 1))
+        np.ndarray(a.shape, a.dtype, buffer = shm.buf)[...] = a
+        blocks[name] = shm
+        specs[name] = (shm.name, a.shape, a.dtype.str)
+    return blocks, specs
+
+def attach_arrays(specs):
+    blocks = dict()
+    arrays = dict()
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name = shm_name)
+        a = np.ndarray(shape, np.dtype(dtype), buffer = shm.buf)
+        a.flags.writeable = False
+        blocks[name] = shm
+        arrays[name] = a
+    return blocks, arrays
+
+def init_worker(specs, polder_args, breach, levels):
+    blocks, arrays = attach_arrays(specs)
+    _sweep_state['blocks'] = blocks
+    cube = arrays['elevation_cube']
+    # the polder starts empty and seeded, so that no layout is built and
+    # nothing is drawn from the global numpy state only to be replaced by
+    # set_elevation
+    polder_args = dict(polder_args)
+    n_households = polder_args.pop('n_households', None)
+    pdr = polder(amplitude = 0.0, noise = 0.0, time_horizon = cube.shape[0] - 1, n_households = 0,
+                 seed = 0, **polder_args)
+    pdr.set_elevation(cube[0], np.array(arrays['plots']), n_households)
+    # the owners raster is identical to the one set_elevation paints
+    pdr.owners = arrays['owners']
+    pdr.elevation_cube = cube
+    if breach is not None:
+        pdr.add_breach(breach[0], breach[1], pdr.time_horizon)
+    _sweep_state['polder'] = pdr
+    _sweep_state['wealth'] = [ (hh, hh.wealth) for hh in pdr.households.values() ]
+    _sweep_state['levels'] = levels
+
+# One point of the grid: the EU series for the horizon, then an election
+# and a seeded auction on it.
+
+def run_point(task):
+    i, horizon, trm_k, discount, wl_k, seed_seq = task
+    pdr = _sweep_state['polder']
+    MHW, MW = _sweep_state['levels']
+    for hh, w in _sweep_state['wealth']:
+        hh.wealth = w
+        hh.discount = discount
+    pdr.calc_eu_series(MHW, trm_k, MW, wl_k, horizon, save = False, n_workers = 1)
+    prefs = pdr.preferences
+    v = election(pdr.households, prefs)
+    v_winner = v.vote()[0]
+    a = auction(pdr.households, prefs, seed = np.random.RandomState(np.random.MT19937(seed_seq)),
+                verbose = False)
+    a_winner = a.auction()[0]
+    rows = [(i, horizon, trm_k, discount, 'election', int(v_winner), prefs.utility(v_winner).min(),
+             v.count_unhappy(v_winner), 0, 0.0),
+            (i, horizon, trm_k, discount, 'auction', int(a_winner), a.utility_array(a_winner).min(),
+             a.count_unhappy(a_winner), len(a.ledger), float(a.ledger.rows['price'].sum()))]
+    return rows
+
+columns = ('point', 'horizon', 'trm_k', 'discount', 'rule', 'winner', 'min_utility', 'unhappy',
+           'n_transactions', 'transfers')
+
+# Run batch() over the grid horizons x trm_k x discount in a pool of
+# n_workers processes. The elevation cube, owners raster and plots of pdr
+# are placed in shared memory once; every worker attaches to them and
+# builds its own polder. Auction seeds come from SeedSequence(seed), one
+# child per grid point, so results do not depend on the number of workers.
+# Returns one row per grid point and rule.
+
+def run_sweep(pdr, MHW, MW, horizons = range(3, 7), trm_ks = (5.0,), discounts = (0.15,), wl_k = 1.0,
+              seed = 0, n_workers = 4, method = 'fork'):
+    grid = list(itertools.product(horizons, trm_ks, discounts))
+    seeds = np.random.SeedSequence(seed).spawn(len(grid))
+    tasks = [ (i, h, k, d, wl_k, s) for i, ((h, k, d), s) in enumerate(zip(grid, seeds)) ]
+    polder_args = {'x':pdr.width, 'y':pdr.height, 'n_households':len(pdr.households),
+                   'max_wealth':pdr.max_wealth, 'max_profit':pdr.max_profit,
+                   'border_height':pdr.border_height}
+    breach = (pdr.breaches[0].x, pdr.breaches[0].y) if len(pdr.breaches) > 0 else None
+    blocks, specs = share_arrays({'elevation_cube':pdr.elevation_cube, 'owners':pdr.owners,
+                                  'plots':pdr.hh_plot_table()})
+    init_args = (specs, polder_args, breach, (float(MHW), float(MW)))
+    try:
+        if n_workers > 1:
+            with mp.get_context(method).Pool(n_workers, init_worker, init_args) as pool:
+                results = pool.map(run_point, tasks)
+        else:
+            init_worker(*init_args)
+            try:
+                results = [ run_point(t) for t in tasks ]
+            finally:
+                _sweep_state.clear()
+    finally:
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
+    return pd.DataFrame([ r for rows in results for r in rows ], columns = columns)
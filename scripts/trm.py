@@ -1,6 +1,6 @@
 #%% Import packages
 import os
-import pickle
+import json
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
@@ -8,44 +8,102 @@ from scipy.signal import argrelextrema
 import squarify as sq
 import time
 import numpy.ma as ma
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+
+from artifact import artifact, write_artifact
 
 #%% Define classes
 
+# The expected utility of every household for every candidate TRM year, as
+# one (household, year) matrix, with the households' ballots: row i of
+# ballots lists the years from household i's most to least preferred, and
+# ranks[i, year] is the position of year on that ballot. Built once per EU
+# series by the polder and shared by the households and decision engines.
+
+class preferences(object):
+    def __init__(self, ids, eu):
+        self.ids = np.array(ids)
+        self.index = dict((hh_id, i) for i, hh_id in enumerate(self.ids))
+        self._eu = np.array(eu, np.double)
+        self._ballots = np.empty(self._eu.shape, np.int64)
+        self._ranks = np.empty(self._eu.shape, np.int64)
+        self._best = np.empty(self._eu.shape[0], np.double)
+        self.eu = read_only(self._eu)
+        self.ballots = read_only(self._ballots)
+        self.ranks = read_only(self._ranks)
+        self.favorite = read_only(self._ballots[:,0])
+        self.best = read_only(self._best)
+        self.update_rows(slice(None), self._eu)
+
+    # Replace the EU of some households (rows) and re-rank them, in place, so
+    # that every view handed out of this object sees the change.
+
+    def update_rows(self, rows, eu):
+        self._eu[rows] = eu
+        ballots = np.argsort(- self._eu[rows], axis = 1, kind = 'stable')
+        ranks = np.empty_like(ballots)
+        np.put_along_axis(ranks, ballots, np.arange(ballots.shape[1])[np.newaxis,:], axis = 1)
+        self._ballots[rows] = ballots
+        self._ranks[rows] = ranks
+        self._best[rows] = self._eu[rows].max(axis = 1)
+
+    @property
+    def n_households(self):
+        return self.eu.shape[0]
+
+    @property
+    def n_years(self):
+        return self.eu.shape[1]
+
+    # Reuse the households' shared preferences when they all point at the
+    # same matrix in the same order, otherwise stack their EU vectors. With
+    # no households the number of years cannot be told from them, so it has
+    # to be given as n_years to get an empty (0 x n_years) object.
+
+    @staticmethod
+    def from_households(hh_dict, n_years = None):
+        hh_list = list(hh_dict.values())
+        if len(hh_list) == 0:
+            if n_years is None:
+                raise ValueError("No households to take preferences from; give n_years for empty preferences")
+            return preferences(np.zeros(0, np.int64), np.zeros((0, n_years)))
+        prefs = getattr(hh_list[0], 'preferences', None)
+        if prefs is not None and all(hh.preferences is prefs for hh in hh_list) and \
+                np.array_equal(prefs.ids, [hh.id for hh in hh_list]):
+            return prefs
+        return preferences([hh.id for hh in hh_list], [hh.eu for hh in hh_list])
+
+    def utility(self, index):
+        return self.eu[:,index]
+
+    def unhappy(self, index):
+        return self.eu[:,index] < self.best
+
+    def count_unhappy(self, index):
+        return int(np.count_nonzero(self.unhappy(index)))
+
 class election(object):
-    def __init__(self, hh_dict):
+    def __init__(self, hh_dict, prefs = None):
         self.households = hh_dict
+        if prefs is None:
+            prefs = preferences.from_households(hh_dict)
+        self.preferences = prefs
 
     def utility(self, index):
-        u = dict( [ (hh.id, hh.eu_df.eu.loc[index]) for hh in self.households.values() ] )
+        u = dict(zip(self.preferences.ids, self.preferences.utility(index)))
         return(u)
 
     def count_unhappy(self, index):
-        utilities = self.utility(index)
-        baseline = dict( [ (hh.id, hh.eu_df.eu.iloc[0]) for hh in self.households.values() ] )
-        n = sum([ baseline[hh_id] > utilities[hh_id] for hh_id in utilities.keys() ])
-        return n
+        return self.preferences.count_unhappy(index)
 
     def vote(self):
-        ballots = np.array( [ np.array(hh.vote(), dtype = np.integer) \
-                  for hh in self.households.values() ] )
-        winner = election.instant_runoff(ballots)
+        winner = election.instant_runoff(self.preferences.ballots)
         return (winner, self.utility(winner))
 
     @staticmethod
     def instant_runoff(ballots):
-        majority = ballots.shape[0] * 0.5
-        n_choices = ballots.shape[1]
-        ballots = pd.DataFrame(ballots)
-        vc = ballots[0].value_counts()
-        while vc.iloc[0] <= majority:
-            vc = ballots[n_choices - 1].value_counts()
-            eliminate = vc.index[0]
-            blist = [ list(x) for x in list(np.array(ballots)) ]
-            for b in blist: b.remove(eliminate)
-            ballots = pd.DataFrame(np.array(blist, dtype = np.integer))
-            n_choices = ballots.shape[1]
-            vc = ballots[0].value_counts()
-        return vc.index[0]
+        return instant_runoff(ballots)
 
 class transaction(object):
     def __init__(self, buyer, seller, year, price):
@@ -60,41 +118,140 @@ class transaction(object):
     def seller_id(self):
         return self.seller.id
 
+# The auction's transactions as columns (buyer, seller, year, price, round),
+# with buyers and sellers as household positions in the preferences. The
+# ledger keeps row indexes per year and per household and running totals:
+# net[year, i] is what household i has received (or, negative, paid) for
+# votes that year, so the utility of a year is its EU plus one row of net.
+
+class ledger(object):
+    def __init__(self, prefs, capacity = 64):
+        self.preferences = prefs
+        n_hh, n_years = prefs.eu.shape
+        self.n = 0
+        self._rows = np.zeros(capacity, ledger_dtype())
+        self.net = np.zeros((n_years, n_hh), np.double)
+        self.bought = np.zeros(n_hh, np.int64)
+        self.sold = np.zeros(n_hh, np.int64)
+        self.first_purchase = np.full(n_hh, -1, np.int64)
+        self._by_year = [ [] for y in range(n_years) ]
+        self._by_household = dict()
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def rows(self):
+        return read_only(self._rows[:self.n])
+
+    # Record the trades of one round, a structured array of trade_dtype with
+    # household ids.
+
+    def record(self, trades, round = 0):
+        k = len(trades)
+        if k == 0:
+            return
+        if self.n + k > self._rows.size:
+            rows = np.zeros(max(2 * self._rows.size, self.n + k), self._rows.dtype)
+            rows[:self.n] = self._rows[:self.n]
+            self._rows = rows
+        index = self.preferences.index
+        buyer = np.array([ index[b] for b in trades['buyer'] ], np.int64)
+        seller = np.array([ index[s] for s in trades['seller'] ], np.int64)
+        year = np.asarray(trades['year'], np.int64)
+        price = np.asarray(trades['price'], np.double)
+        new = self._rows[self.n:(self.n + k)]
+        new['buyer'] = buyer
+        new['seller'] = seller
+        new['year'] = year
+        new['price'] = price
+        new['round'] = round
+        np.add.at(self.net, (year, buyer), - price)
+        np.add.at(self.net, (year, seller), price)
+        np.add.at(self.bought, buyer, 1)
+        np.add.at(self.sold, seller, 1)
+        first = self.first_purchase[buyer]
+        self.first_purchase[buyer] = np.where(first < 0, year, first)
+        for r, b, s, y in zip(range(self.n, self.n + k), buyer, seller, year):
+            self._by_year[y].append(r)
+            self._by_household.setdefault(b, []).append(r)
+            self._by_household.setdefault(s, []).append(r)
+        self.n += k
+
+    def year_rows(self, year):
+        return self.rows[self._by_year[year]]
+
+    def household_rows(self, i):
+        return self.rows[self._by_household.get(i, [])]
+
+    # Households that have neither bought nor sold.
+
+    def neutral(self):
+        return (self.bought == 0) & (self.sold == 0)
+
 class auction(object):
-    def __init__(self, hh_dict):
+    def __init__(self, hh_dict, prefs = None, seed = None, verbose = True):
         self.households = hh_dict
-        self.transactions = []
+        self.verbose = verbose
+        # seed is None (global numpy state), a RandomState, or anything
+        # RandomState accepts, such as an int or a bit generator
+        if seed is None:
+            self.rng = np.random
+        elif isinstance(seed, np.random.RandomState):
+            self.rng = seed
+        else:
+            self.rng = np.random.RandomState(seed)
+        if prefs is None:
+            prefs = preferences.from_households(hh_dict)
+        self.preferences = prefs
+        self.ledger = None
         self.ballots = None
         self.initialize_votes()
 
+    # The transactions so far as objects, built from the ledger.
+
+    @property
+    def transactions(self):
+        ids = self.preferences.ids
+        return [ transaction(self.households[ids[r['buyer']]], self.households[ids[r['seller']]],
+                             int(r['year']), r['price']) for r in self.ledger.rows ]
+
+    def utility_array(self, index):
+        return self.preferences.utility(index) + self.ledger.net[index]
+
     def utility(self, index):
-        u = dict( [ (hh.id, hh.eu_df.eu.loc[index]) for hh in self.households.values() ] )
-        trans = [t for t in self.transactions if t.year == index]
-        for t in trans:
-            # print "Transaction: buyer = ", t.buyer_id(), ", seller = ", t.seller_id(), ", year = ", t.year[0], ", price = ", t.price
-            u[t.buyer_id()] -= t.price
-            u[t.seller_id()] += t.price
+        u = dict(zip(self.preferences.ids, self.utility_array(index)))
         return(u)
 
+    # Households whose favorite year is not index and who end up worse off
+    # than with their favorite, even after the transfers.
+
+    def unhappy_mask(self, index):
+        prefs = self.preferences
+        return (prefs.favorite != index) & (self.utility_array(index) < prefs.best)
+
     def unhappy(self, index):
-        potentially_unhappy = dict([(hh.id, hh.eu_df) for hh in self.households.values() if hh.eu_df.index[0] != index])
-        u = self.utility(index)
-        utilities = dict([(k, u[k]) for k in potentially_unhappy.keys()])
-        baseline = dict( [ (k, potentially_unhappy[k].iloc[0]) for k in potentially_unhappy.keys()])
-        unhappy = dict([(k, (utilities[k], potentially_unhappy[k])) \
-                        for k in potentially_unhappy.keys() \
-                        if utilities[k] < potentially_unhappy[k].iloc[0].eu])
+        mask = self.unhappy_mask(index)
+        u = self.utility_array(index)
+        unhappy = dict([(hh_id, (u[i], self.households[hh_id].eu_df)) \
+                        for i, hh_id in zip(np.flatnonzero(mask), self.preferences.ids[mask])])
         return unhappy
     
     def count_unhappy(self, index):
-        return len(self.unhappy(index))
+        return int(np.count_nonzero(self.unhappy_mask(index)))
     
     def vote(self, force = False):
         if self.ballots is None:
             return None
         majority = 0.5 * self.ballots.shape[0]
-        votes = pd.DataFrame(self.ballots)[0].value_counts()
-        print(votes)
+        counts = np.bincount(self.ballots[:,0], minlength = self.preferences.n_years)
+        votes = pd.Series(counts).sort_values(ascending = False, kind = 'stable')
+        votes = votes[votes > 0]
+        if self.verbose:
+            print(votes)
+        if votes.size == 0:
+            # no households: every year ties and the earliest wins
+            return 0
         if votes.iloc[0] > majority:
             return votes.index[0]
         elif force:
@@ -102,116 +259,201 @@ class auction(object):
         return None
 
     def initialize_votes(self):
-        self.ballots = np.array( [ hh.vote() for hh in self.households.values() ] )
-        self.transactions = []
+        self.ballots = np.array(self.preferences.ballots)
+        self.ledger = ledger(self.preferences)
 
     def auction(self, max_rounds = 1000):
         global tt, bbids
         self.initialize_votes()
         for round in range(max_rounds):
-            print("Round ", round)
+            if self.verbose:
+                print("Round ", round)
             winner = self.vote()
             if winner is not None:
                 return (winner, self.utility(winner))
             target = self.vote(force = True)
-            print("Target = ", target)
-            buyers  = [trans.buyer for trans in self.transactions]
-            sellers = [trans.seller for trans in self.transactions]
-            buyer_ids = [ b.id for b in buyers ]
-            seller_ids = [ s.id for s in sellers ]
-            neutral_ids = list(set(self.households.keys()) - set(buyer_ids) - set(seller_ids))
-            neutral = [ self.households[hh_id] for hh_id in neutral_ids ]
-            for hh in neutral:
-                hh.construct_bids(target)
-            for hh in buyers:
-                purchases = [ t for t in self.transactions if t.buyer_id() == hh.id ]
-                hh.construct_bids(target, purchases)
-            bids = pd.concat([hh.bids for hh in neutral + buyers])
+            if self.verbose:
+                print("Target = ", target)
+            bids = self.construct_bids(target, self.ledger.neutral(), self.ledger.first_purchase)
             bbids = bids.copy()
-            transactions = self.bidding_round(bids)
-            tt = transactions
-            for trans in transactions:
-                trans.buyer.wealth -= trans.price
-                trans.seller.wealth += trans.price
-                self.ballots[trans.seller_id()] = trans.year
-            if len(transactions) > 0:
-                print(len(transactions), " Transactions")
-                self.transactions += transactions
+            trades = self.bidding_round(bids)
+            tt = trades
+            for t in trades:
+                self.households[t['buyer']].wealth -= t['price']
+                self.households[t['seller']].wealth += t['price']
+                self.ballots[self.preferences.index[t['seller']]] = t['year']
+            if len(trades) > 0:
+                if self.verbose:
+                    print(len(trades), " Transactions")
+                self.ledger.record(trades, round)
             else:
-                print("No transactions")
+                if self.verbose:
+                    print("No transactions")
                 break
         winner = self.vote(force = True)
         return (winner, self.utility(winner))
 
-    def bidding_round(self,bids):
-        global pp, wtpp, wtaa, p0, bcc, scc
+    # Bids of the whole population for one round, as a structured array of
+    # bid_dtype, following household.construct_bids: a neutral household
+    # (one that has neither bought nor sold) offers to sell its vote for
+    # every year but its favorite, asking for its loss of EU scaled up by a
+    # random factor, and offers to buy votes for its favorite, up to its
+    # gain over the target (or its second choice, if the target is its
+    # favorite) scaled down by another. A household that has bought before
+    # (purchase_year >= 0) only makes the offer, and only if it is for the
+    # year of its first purchase. Households that have sold do not bid.
+
+    def construct_bids(self, target, neutral, purchase_year, bid_scale = 1.1):
+        prefs = self.preferences
+        n_hh, n_years = prefs.eu.shape
+        rows = np.arange(n_hh)
+        favorite = prefs.favorite
+        if n_years > 1:
+            other = np.where(favorite == target, prefs.ballots[:,1], target)
+        else:
+            other = favorite
+        sell_scale = self.rng.uniform(1.0, bid_scale, n_hh)
+        buy_scale = self.rng.uniform(1.0, bid_scale, n_hh)
+        buy_amount = (prefs.best - prefs.eu[rows, other]) / buy_scale
+        buy = (neutral | (purchase_year == favorite)) & (buy_amount > 0.0)
+        sell_amount = (prefs.best[:,np.newaxis] - prefs.eu) * sell_scale[:,np.newaxis]
+        sell = neutral[:,np.newaxis] & (sell_amount > 0.0)
+        sell[rows, favorite] = False
+        sell_hh, sell_year = np.nonzero(sell)
+        bids = np.empty(np.count_nonzero(buy) + sell_hh.size, bid_dtype(prefs.ids.dtype))
+        n_buy = np.count_nonzero(buy)
+        bids['id'][:n_buy] = prefs.ids[buy]
+        bids['year'][:n_buy] = favorite[buy]
+        bids['is_offer'][:n_buy] = True
+        bids['amount'][:n_buy] = buy_amount[buy]
+        bids['id'][n_buy:] = prefs.ids[sell_hh]
+        bids['year'][n_buy:] = sell_year
+        bids['is_offer'][n_buy:] = False
+        bids['amount'][n_buy:] = sell_amount[sell_hh, sell_year]
+        return bids
+
+    # Each buyer, in random order, is matched with a seller drawn uniformly
+    # among those still selling whose ask for the buyer's year is at most
+    # the buyer's offer, at the price (offer + accept) / 2. A buyer buys
+    # once and a seller sells once per round. Bids are (id, year, is_offer,
+    # amount) columns, as a DataFrame or a structured array; the trades come
+    # back as a structured array of trade_dtype.
+
+    def bidding_round(self, bids):
         transactions = []
-        wta = bids[np.logical_not(bids.is_offer.values)][['id', 'year','amount']]
-        wtp = bids[bids.is_offer.values][['id', 'year','amount']]
-        wtpp = wtp.copy()
-        wtaa = wta.copy()
-        wta = wta[np.logical_not(wta.duplicated())]
-        wtp = wtp[np.logical_not(wtp.duplicated())]
-        # wta = wta.drop_duplicates(inplace = True)
-        # wtp = wtp.drop_duplicates(inplace = True)
-        if wta is None or wta.shape[0] < 2:
-            # print "Empty wta"
-            return transactions
-        if wtp is None or wtp.shape[0] < 2:
-            # print "Empty wtp"
-            return transactions
-        wta = wta.pivot(index = 'id', columns = 'year', values = 'amount')
-        wtp = wtp.pivot(index = 'id', columns = 'year', values = 'amount')
-        wtpp = wtp.copy()
-        wtaa = wta.copy()
-        wta_min = wta.min()
-        wtp_max = wtp.max()
-        for buyer_index in np.random.choice(wtp.index, wtp.shape[0], replace = False):
-            buyer = wtp.loc[buyer_index]
-            buyer_year = buyer[np.logical_not(buyer.isnull())]
-            offer = buyer_year.values[0]
-            # print "Buyer_year.index - ", buyer_year.index
-            # print "WTA.columns = ", wta.columns
-            if buyer_year.index.values in wta.columns.values:
-                seller_candidates = wta[buyer_year.index]
-            else:
-                continue
-            seller_candidates = seller_candidates[np.logical_not(pd.isnull(seller_candidates.values))[:,0]]
-            seller_candidates = seller_candidates[(seller_candidates.values <= offer)[:,0]]
-            if seller_candidates.shape[0] > 0:
-                # print "Year ", buyer_year.index[0], ": ", buyer.index[0], " offers ", offer
-                # print "     seller_candidates has shape ", seller_candidates.shape
-                seller_index = np.random.choice(seller_candidates.index, 1)[0]
-                seller = seller_candidates.loc[seller_index]
-                accept = seller.values[0]
-                # print "Year ", buyer_year.index[0], ": ", buyer.index[0], " offers ", offer, " and ", \
-                #        seller.index[0], " will accept ", accept
-                if  offer >= accept:
-                    price = (offer + accept) / 2.0
-                    # print "Offer accepted: price = ", price
-                    if True: # self.households[p.buyer].wealth >= price:
-                        # print buyer_index, seller_index
-                        bh = self.households[buyer_index]
-                        sh = self.households[seller_index]
-                        tx = transaction(bh, sh, buyer_year.index, price)
-                        transactions.append(tx)
-                        wtp.drop(buyer_index, inplace = True)
-                        wta.drop(seller_index, inplace = True)
-                else:
-                    # print "Offer rejected."
-                    pass
-            if wta.shape[0] == 0 or wtp.shape[0] == 0:
+        ids = np.asarray(bids['id'])
+        years = np.asarray(bids['year'], np.int64)
+        is_offer = np.asarray(bids['is_offer'], bool)
+        amounts = np.asarray(bids['amount'], np.double)
+        # one ask per seller and year and one offer (the earliest year) per buyer
+        ask = np.flatnonzero(~ is_offer)
+        ask = ask[np.unique(np.column_stack((ids[ask], years[ask])), axis = 0, return_index = True)[1]]
+        offer = np.flatnonzero(is_offer)
+        offer = offer[np.lexsort((years[offer], ids[offer]))]
+        offer = offer[np.unique(ids[offer], return_index = True)[1]]
+        if ask.size < 2 or offer.size < 2:
+            return np.array(transactions, trade_dtype(ids.dtype))
+        book = order_book(ids[ask], years[ask], amounts[ask])
+        for i in offer[self.rng.permutation(offer.size)]:
+            n_eligible, k = book.eligible(years[i], amounts[i])
+            if n_eligible > 0:
+                seller_id, accept = book.take(years[i], self.rng.randint(n_eligible))
+                price = (amounts[i] + accept) / 2.0
+                transactions.append((ids[i], seller_id, years[i], price))
+            if book.n_sellers == 0:
                 break
-        # print len(transactions), " transactions."
-        return transactions
+        return np.array(transactions, trade_dtype(ids.dtype))
+
+# Ask books for the auction: for every year, the asks sorted by amount, with
+# a Fenwick tree over the sorted positions counting the sellers that have
+# not sold yet. A seller that sells is removed from every year's book at
+# once, so finding the eligible sellers for an offer, drawing one of them
+# and removing it cost O(log sellers) each.
+
+class order_book(object):
+    def __init__(self, seller_ids, years, asks):
+        self.seller_ids, seller = np.unique(seller_ids, return_inverse = True)
+        self.n_sellers = self.seller_ids.size
+        self.active = np.ones(self.n_sellers, bool)
+        n_years = years.max() + 1
+        order = np.lexsort((seller, asks, years))
+        years, seller, asks = years[order], seller[order], asks[order]
+        start = np.searchsorted(years, np.arange(n_years + 1))
+        self.length = np.diff(start)
+        size = max(int(self.length.max()), 1)
+        self.asks = np.full((n_years, size), np.inf)
+        self.seller = np.full((n_years, size), -1, np.int64)
+        slot = np.arange(years.size) - start[years]
+        self.asks[years, slot] = asks
+        self.seller[years, slot] = seller
+        self.position = np.full((n_years, self.n_sellers), -1, np.int64)
+        self.position[years, seller] = slot
+        # a Fenwick tree over ones in positions [0, length)
+        i = np.arange(size + 1)
+        low = i - (i & - i)
+        self.tree = np.clip(np.minimum(i[np.newaxis,:], self.length[:,np.newaxis]) - low[np.newaxis,:], 0, None)
+        self.tree[:,0] = 0
+        self.log_size = 1 << int(np.floor(np.log2(size)))
+
+    # Number of sellers still active with ask[year] <= offer.
+
+    def eligible(self, year, offer):
+        if year >= self.length.size:
+            return (0, 0)
+        k = int(np.searchsorted(self.asks[year], offer, side = 'right'))
+        tree = self.tree[year]
+        count = 0
+        i = k
+        while i > 0:
+            count += tree[i]
+            i -= i & - i
+        return (int(count), k)
+
+    # Remove and return the r-th (from 0) active seller in year's book, in
+    # order of ask, with its ask.
+
+    def take(self, year, r):
+        tree = self.tree[year]
+        i = 0
+        step = self.log_size
+        while step > 0:
+            if i + step < tree.size and tree[i + step] <= r:
+                i += step
+                r -= tree[i]
+            step >>= 1
+        s = self.seller[year, i]
+        accept = self.asks[year, i]
+        self.remove(s)
+        return (self.seller_ids[s], accept)
+
+    def remove(self, s):
+        if not self.active[s]:
+            return
+        self.active[s] = False
+        self.n_sellers -= 1
+        year = np.flatnonzero(self.position[:,s] >= 0)
+        i = self.position[year, s] + 1
+        size = self.tree.shape[1]
+        while year.size > 0:
+            self.tree[year, i] -= 1
+            i = i + (i & - i)
+            keep = i < size
+            year, i = year[keep], i[keep]
 
 class household(object):
     def __init__(self, id, wealth = 0, plots = None, discount = 0.03, eu_df = None):
         self.id = id
         self.wealth = wealth
         self.discount = discount
-        self.eu_df = eu_df
-        self.bids = pd.DataFrame(index = [], columns = ['id', 'year', 'is_offer', 'amount'])
+        self.preferences = None
+        self.eu = None
+        self.ballot = None
+        self._eu_df = None
+        if eu_df is not None:
+            self.set_eu(eu_df)
+        # set by construct_bids; an empty DataFrame per household made
+        # building large populations slow
+        self.bids = None
         if plots is None:
             self.plots = np.zeros((0,5), dtype=np.integer)
         else:
@@ -220,13 +462,33 @@ class household(object):
     def utility(self, profit_dc):
         own_patches_profit = np.concatenate([ household.extract_and_collapse(profit_dc, p) \
                                              for p in self.plots ],
-                                      axis = 0)
-        profit = np.sum(own_patches_profit, axis = 0)
+                                      axis = 1)
+        profit = np.sum(own_patches_profit, axis = 1)
         eu = np.sum(profit * np.exp(- self.discount * np.arange(len(profit))))
         return eu
 
+    # The household's EU and ballot are rows of the polder's shared
+    # preference matrix; eu_df is only built when something asks for it.
+
+    def set_preferences(self, prefs, i):
+        self.preferences = prefs
+        self.eu = prefs.eu[i]
+        self.ballot = prefs.ballots[i]
+        self._eu_df = None
+
     def set_eu(self, eu_df):
-        self.eu_df = eu_df.sort_values('eu', ascending = False)
+        eu_df = eu_df.sort_values('eu', ascending = False)
+        self.preferences = None
+        self.eu = read_only(eu_df.eu.sort_index().values)
+        self.ballot = read_only(eu_df.index.values)
+        self._eu_df = eu_df
+
+    @property
+    def eu_df(self):
+        if self._eu_df is None and self.eu is not None:
+            self._eu_df = pd.DataFrame({'year':self.ballot, 'eu':self.eu[self.ballot]},
+                                       index = self.ballot)
+        return self._eu_df
 
     def construct_bids(self, target, purchases = []):
         bid_scale = 1.1
@@ -260,7 +522,7 @@ class household(object):
         self.bids = self.bids[self.bids.amount > 0.0]
 
     def vote(self):
-        return self.eu_df.year.copy()
+        return self.ballot
 
     #==========================================================================
     # EXTRACT A RECTANGULAR SECTION THROUGH A CUBE AND COLLAPSE
@@ -272,10 +534,156 @@ class household(object):
 
     @staticmethod
     def extract_and_collapse(dc, p):
-        x = dc[:,p[1]:(p[1] + p[3]),p[0]:(p[0] + p[2])].copy()
+        x = dc[:,p[1]:(p[1] + p[3]),p[0]:(p[0] + p[2])]
         x = x.reshape((x.shape[0], x.shape[1] * x.shape[2]))
         return x
 
+# Index of the cells of a label raster by label, in compressed (CSR) form:
+# the flat indices of the cells with label i are cells[offsets[i]:offsets[i+1]],
+# in increasing order. Cells with negative labels are left out. Built once,
+# from a label raster with a sorted permutation or from a plot table without
+# a raster, it gathers the cells of any raster of the same shape label by
+# label and reduces them over all labels in one pass with reduceat.
+
+class label_index(object):
+    def __init__(self, labels, n_labels = None):
+        flat = labels.ravel()
+        cells = np.flatnonzero(flat >= 0)
+        lab = flat[cells]
+        if n_labels is None:
+            n_labels = lab.max() + 1 if lab.size > 0 else 0
+        self.set_cells(labels.shape, cells[np.argsort(lab, kind = 'stable')],
+                       np.bincount(lab, minlength = n_labels))
+
+    def set_cells(self, shape, cells, counts):
+        self.shape = tuple(shape)
+        self.cells = cells
+        self.counts = counts
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    # Build the index directly from a table of (x, y, dx, dy, label) plots,
+    # as runs of cells along the rows they cover. Overlapping plots go
+    # through their raster instead, so the later plot wins as it does there.
+
+    @staticmethod
+    def from_plots(plots, shape, n_labels = None):
+        plots = np.asarray(plots).reshape((-1, 5))
+        plot, start, stop = plot_runs(plots, shape)
+        if np.any(start[1:] < stop[:-1]):
+            return label_index(rasterize_plots(plots, shape), n_labels)
+        label = plots[plot,4]
+        valid = label >= 0
+        label, start, stop = label[valid], start[valid], stop[valid]
+        if n_labels is None:
+            n_labels = label.max() + 1 if label.size > 0 else 0
+        order = np.argsort(label, kind = 'stable')
+        label = label[order]
+        start = start[order]
+        length = stop[order] - start
+        run_offsets = np.cumsum(length) - length
+        cells = np.repeat(start - run_offsets, length) + np.arange(length.sum())
+        index = label_index.__new__(label_index)
+        index.set_cells(shape, cells, np.bincount(label, weights = length, minlength = n_labels).astype(np.int64))
+        return index
+
+    @property
+    def n_labels(self):
+        return self.counts.size
+
+    # The index restricted to labels lo to hi - 1, sharing this one's arrays.
+
+    def subset(self, lo, hi):
+        index = label_index.__new__(label_index)
+        index.shape = self.shape
+        index.cells = self.cells[self.offsets[lo]:self.offsets[hi]]
+        index.counts = self.counts[lo:hi]
+        index.offsets = self.offsets[lo:(hi + 1)] - self.offsets[lo]
+        return index
+
+    # Split the labels into at most n contiguous ranges with about the same
+    # number of cells each, as (lo, hi) pairs.
+
+    def split(self, n):
+        edges = np.searchsorted(self.offsets, np.linspace(0, self.cells.size, n + 1), 'left')
+        edges = np.unique(np.clip(edges, 0, self.n_labels))
+        edges[0], edges[-1] = 0, self.n_labels
+        return [ (edges[i], edges[i + 1]) for i in range(len(edges) - 1) if edges[i + 1] > edges[i] ]
+
+    # Values of raster (or of every layer of a (t, y, x) cube) in index order.
+
+    def gather(self, raster, out = None):
+        raster = np.asarray(raster)
+        if raster.shape == self.shape:
+            return np.take(raster.ravel(), self.cells, out = out)
+        return np.take(raster.reshape((raster.shape[0], -1)), self.cells, axis = 1, out = out)
+
+    # Apply ufunc.reduceat over the cells of each label, along the last axis
+    # of values gathered in index order. Labels without cells get empty.
+
+    def reduce_gathered(self, ufunc, values, empty = np.nan):
+        out = np.full(values.shape[:-1] + (self.n_labels,), empty, np.result_type(values, empty))
+        nonempty = self.counts > 0
+        if values.shape[-1] > 0:
+            out[...,nonempty] = ufunc.reduceat(values, self.offsets[:-1][nonempty], axis = -1)
+        return out
+
+    def reduce(self, ufunc, raster, empty = np.nan):
+        return self.reduce_gathered(ufunc, self.gather(raster), empty)
+
+    def sum(self, raster):
+        return self.reduce(np.add, raster, 0.0)
+
+    def min(self, raster):
+        return self.reduce(np.minimum, raster)
+
+    def max(self, raster):
+        return self.reduce(np.maximum, raster)
+
+    def mean(self, raster):
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return self.sum(raster) / self.counts
+
+    def stats(self, raster):
+        total = self.sum(raster)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            mean = total / self.counts
+        return {'count':self.counts, 'sum':total, 'mean':mean,
+                'min':self.min(raster), 'max':self.max(raster)}
+
+    # Move cells (all currently labelled a) to label b. Only the stretch of
+    # cells between the two labels' segments is rewritten, and only the
+    # offsets of the labels in between shift.
+
+    def move_cells(self, cells, a, b):
+        if a == b or len(cells) == 0:
+            return
+        cells = np.sort(cells)
+        k = cells.size
+        lo, hi = min(a, b), max(a, b)
+        seg_a = self.cells[self.offsets[a]:self.offsets[a + 1]]
+        seg_b = self.cells[self.offsets[b]:self.offsets[b + 1]]
+        new_a = seg_a[~np.isin(seg_a, cells, assume_unique = True)]
+        new_b = np.insert(seg_b, np.searchsorted(seg_b, cells), cells)
+        middle = self.cells[self.offsets[lo + 1]:self.offsets[hi]]
+        if a < b:
+            stretch = np.concatenate((new_a, middle, new_b))
+            self.offsets[(a + 1):(b + 1)] -= k
+        else:
+            stretch = np.concatenate((new_b, middle, new_a))
+            self.offsets[(b + 1):(a + 1)] += k
+        self.cells[self.offsets[lo]:self.offsets[hi + 1]] = stretch
+        self.counts[a] -= k
+        self.counts[b] += k
+
+    # Raster with values[i] on the cells of label i and empty elsewhere.
+
+    def paint(self, values, out = None, empty = 0.0):
+        if out is None:
+            out = np.empty(self.shape, np.result_type(values, empty))
+        out.fill(empty)
+        out.ravel()[self.cells] = np.repeat(values, self.counts)
+        return out
+
 class breach(object):
     def __init__(self, pldr, breach_x, breach_y, breach_z):
         self.pldr = pldr
@@ -297,16 +705,38 @@ class polder(object):
                  gini = 0.3,
                  border_height = 1.0,
                  amplitude = 1.5,
-                 noise = 0.05):
+                 noise = 0.05,
+                 n_workers = 1,
+                 plot_method = 'squarify',
+                 seed = None):
+        # with a seed the elevation noise and parcel layout come from the
+        # polder's own generator, so that a layout can be regenerated
+        if seed is None:
+            self.rng = np.random
+        else:
+            self.rng = np.random.RandomState(seed)
         self.width = x
         self.height = y
         self.border_height = border_height
         self.max_wealth = max_wealth
         self.max_profit = max_profit
         self.time_horizon = time_horizon
+        self.n_workers = n_workers
+        self.plot_method = plot_method
         self.breach_duration = 0
         self.current_period = 0
         self.plots = np.zeros(shape = (0,5), dtype = np.integer)
+        self._ownership = None
+        self.hh_land = None
+        self.hh_profit = None
+        self.year = 0
+        self.forecast_layers = 0
+        self.history = []
+        # with carry_sediment, the suspended sediment left at the end of a
+        # year of aggradation is the starting concentration of the next,
+        # kept per layer of the elevation cube in sediment_cube
+        self.carry_sediment = False
+        self.sediment_cube = None
         self.breaches = []
         self.initialize_elevation(border_height = border_height,
                                   amplitude = amplitude, noise = noise)
@@ -320,14 +750,15 @@ class polder(object):
         self.elevation = border_height - amplitude * \
               np.outer(np.sin(np.arange(self.height) * wy),
                         np.sin(np.arange(self.width) * wx)) + \
-              noise * np.random.normal(0.0, 1.0, (self.height, self.width))
+              noise * self.rng.normal(0.0, 1.0, (self.height, self.width))
         self.elevation_cube = np.zeros((self.time_horizon + 1, self.height, self.width))
         self.elevation_cube[0] = self.elevation
         self.current_period = 0
 
     def set_elevation(self, elevation, plots, n_households = None):
         if n_households is None:
-            n_households = len(self.households)
+            n_households = max(len(self.households), plots[:,4].max() + 1)
+        self.height, self.width = elevation.shape
         self.elevation = elevation
         self.owners = np.zeros_like(self.elevation, dtype = np.integer)
         self.plots = plots
@@ -339,15 +770,12 @@ class polder(object):
     def initialize_hh(self, n_households):
         self.owners = np.zeros_like(self.elevation, dtype = np.integer)
         self.households = dict()
+        self.invalidate_ownership()
         if n_households > 0:
             self.build_households(n_households)
-            self.owners.fill(-1)
-            for hh in self.households.values():
-                for p in hh.plots:
-                    self.owners[p[1]:(p[1]+p[3]),p[0]:(p[0]+p[2])] = hh.id
 
     def initialize_hh_from_plots(self, n_households):
-        assert max(self.owners) < n_households
+        assert self.plots[:,4].max() < n_households
         self.households = dict([(i, household(id = i)) for i in range(n_households)])
         self.set_hh_plots()
 
@@ -358,6 +786,7 @@ class polder(object):
             # list of households
             self.households = dict((hh.id, hh) for hh in households)
         self.owners = np.zeros_like(self.elevation, dtype = np.integer)
+        self.plots = self.hh_plot_table()
         self.set_owners_wealth()
 
     def set_hh_wealth(self, hh):
@@ -368,12 +797,34 @@ class polder(object):
         else:
             hh.wealth = self.max_wealth * np.sqrt(z.size) * (z.mean() - z0) / (self.border_height - z0)
 
+    # Wealth of every household from the count and mean elevation of its
+    # cells, reduced over the owners raster in a single pass. The counts and
+    # elevation sums are kept in hh_land for transfer_plot.
+
     def set_owners_wealth(self):
-        self.owners.fill(-1.0)
-        for hh in self.households.values():
-            for p in hh.plots:
-                self.owners[p[1]:(p[1]+p[3]),p[0]:(p[0]+p[2])] = hh.id
-            self.set_hh_wealth(hh)
+        self.owners = rasterize_plots(self.hh_plot_table(), self.elevation.shape, self.owners.dtype)
+        self.invalidate_ownership()
+        if len(self.households) == 0:
+            return
+        index = self.ownership
+        self.hh_land = np.array([index.counts, index.sum(self.elevation)], np.double)
+        wealth = self.land_value(*self.hh_land)
+        for hh, w in zip(self.households.values(), wealth):
+            hh.wealth = w
+
+    def land_value(self, count, elevation_sum):
+        count = np.asarray(count, np.double)
+        z0 = self.elevation.min() - 0.5
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            mean = elevation_sum / count
+        value = self.max_wealth * np.sqrt(count) * (mean - z0) / (self.border_height - z0)
+        return np.where(count > 0, value, 0.0)
+
+    # The (x, y, dx, dy, owner) table of the plots the households hold.
+
+    def hh_plot_table(self):
+        table = [ (p[0], p[1], p[2], p[3], hh.id) for hh in self.households.values() for p in hh.plots ]
+        return np.array(table, dtype = np.int64).reshape((len(table), 5))
 
     def set_hh_plots(self):
         for hh in self.households.values():
@@ -401,16 +852,65 @@ class polder(object):
                  axis = 1)
         return plots
 
-    def build_plots(self, weights, n_boxes = 10):
+    # Tile a width x height rectangle with one plot per weight, with areas
+    # proportional to the weights, by recursive binary splitting: every group
+    # of consecutive weights is cut at its weighted median, across the longer
+    # side of its rectangle. All groups of a level are split at once, so the
+    # cost is a few array operations per level, about log2(n) levels. Returns
+    # the (x, y, dx, dy, owner) plot table, where owner is the weight's index.
+
+    @staticmethod
+    def split_plots(weights, width, height):
+        weights = np.asarray(weights, np.double)
+        n = weights.size
+        cum = np.concatenate(([0.0], np.cumsum(weights)))
+        lo = np.array([0])
+        hi = np.array([n])
+        box = np.array([[0, 0, width, height]])
+        done = []
+        while lo.size > 0:
+            leaf = (hi - lo) == 1
+            done.append(np.column_stack((box[leaf,0], box[leaf,1],
+                                         box[leaf,2] - box[leaf,0], box[leaf,3] - box[leaf,1], lo[leaf])))
+            lo, hi, box = lo[~leaf], hi[~leaf], box[~leaf]
+            if lo.size == 0:
+                break
+            total = cum[hi] - cum[lo]
+            target = cum[lo] + 0.5 * total
+            mid = np.searchsorted(cum, target)
+            lower = np.clip(mid - 1, lo + 1, hi - 1)
+            mid = np.clip(mid, lo + 1, hi - 1)
+            mid = np.where(np.abs(cum[lower] - target) <= np.abs(cum[mid] - target), lower, mid)
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                frac = np.where(total > 0, (cum[mid] - cum[lo]) / total, (mid - lo) / (hi - lo))
+            x0, y0, x1, y1 = box.T
+            vertical = (x1 - x0) >= (y1 - y0)
+            cut = np.where(vertical, x0 + np.round(frac * (x1 - x0)), y0 + np.round(frac * (y1 - y0)))
+            cut = cut.astype(box.dtype)
+            first = np.column_stack((x0, y0, np.where(vertical, cut, x1), np.where(vertical, y1, cut)))
+            second = np.column_stack((np.where(vertical, cut, x0), np.where(vertical, y0, cut), x1, y1))
+            lo, hi = np.concatenate((lo, mid)), np.concatenate((mid, hi))
+            box = np.concatenate((first, second))
+        plots = np.concatenate(done).astype(np.int64)
+        return plots[np.argsort(plots[:,4])]
+
+    def build_plots(self, weights, n_boxes = 10, method = None):
+        if method is None:
+            method = self.plot_method
+        if method == 'split':
+            self.plots = self.split_plots(self.rng.permutation(weights), self.width, self.height)
+            return
+        elif method != 'squarify':
+            raise ValueError("Unknown plot method %s" % method)
         n = int(weights.size / n_boxes)
         remainder = weights.size % n
-        w = np.random.choice(weights, weights.size, False)
+        w = self.rng.choice(weights, weights.size, False)
         wr = w[0:remainder]
         w = w[remainder:]
-        w_list = np.random.choice(w, size = (n_boxes, n), replace = False)
+        w_list = self.rng.choice(w, size = (n_boxes, n), replace = False)
         w_list = [ w_list[i] for i in range(w_list.shape[0])]
         if remainder > 0:
-            i_dest = np.random.choice(n_boxes, remainder, replace = True)
+            i_dest = self.rng.choice(n_boxes, remainder, replace = True)
             for i, j in enumerate(i_dest):
                 w_list[j] = np.append(w_list[j], wr[i])
         grid_weights = [ np.sum(x) for x in w_list ]
@@ -451,63 +951,334 @@ class polder(object):
             gini_land = gini
 
         alpha = (1.0 / gini_land + 1.0) / 2.0
-        weights = np.random.pareto(alpha, size = len(self.households))
+        weights = self.rng.pareto(alpha, size = len(self.households))
 
         self.build_plots(weights)
         self.set_hh_plots()
 
-    def calc_profit(self, water_level, k, elevation_cube = None, save = True):
+    # Evaluate max_profit * logit(z, k, water_level / 2) over the time axis
+    # of an elevation cube, chunk_size layers at a time. The same buffer is
+    # filled in place and yielded as (start, stop, profit) for every chunk,
+    # so callers must consume (or copy) it before asking for the next one.
+
+    def profit_chunks(self, water_level, k, elevation_cube = None, chunk_size = 1):
+        if elevation_cube is None:
+            elevation_cube = self.elevation_cube
+        n_layers = elevation_cube.shape[0]
+        chunk_size = max(1, min(int(chunk_size), n_layers))
+        buf = np.empty((chunk_size,) + elevation_cube.shape[1:], np.double)
+        for start in range(0, n_layers, chunk_size):
+            stop = min(start + chunk_size, n_layers)
+            profit = buf[:(stop - start)]
+            logit(elevation_cube[start:stop], k, water_level / 2.0, out = profit)
+            profit *= self.max_profit
+            yield (start, stop, profit)
+
+    def calc_profit(self, water_level, k, elevation_cube = None, save = True, chunk_size = 1):
         if elevation_cube is None:
             elevation_cube = self.elevation_cube
-        profit = self.max_profit * logit(elevation_cube, k, water_level / 2.0)
+        profit = np.empty(elevation_cube.shape, np.double)
+        for start, stop, p in self.profit_chunks(water_level, k, elevation_cube, chunk_size):
+            profit[start:stop] = p
         if save:
-            self.profit = profit.copy()
+            # the polder keeps a read-only copy and the caller gets a writable
+            # array, as before the cache was protected
+            self.profit = read_only(profit.copy())
         return profit
 
-    def calc_eu(self, profit_cube = None, save = True):
+    # Household ids in the order used for the columns of per-household arrays.
+
+    def hh_ids(self):
+        return np.array(list(self.households.keys()), dtype = np.int64)
+
+    def hh_discount(self):
+        return np.array([hh.discount for hh in self.households.values()], np.double)
+
+    # Which cells belong to which household, as a label_index over household
+    # positions in hh_ids() order. It is built from the plots the households
+    # hold the first time it is needed and dropped whenever the polder is
+    # re-partitioned.
+
+    @property
+    def ownership(self):
+        if self._ownership is None:
+            ids = self.hh_ids()
+            table = self.hh_plot_table()
+            position = np.full(max(ids.max(initial = -1), table[:,4].max(initial = -1)) + 1, -1, np.int64)
+            position[ids] = np.arange(ids.size)
+            table[:,4] = position[table[:,4]]
+            self._ownership = label_index.from_plots(table, self.elevation.shape, ids.size)
+            self._hh_position = dict(zip(ids, range(ids.size)))
+        return self._ownership
+
+    def invalidate_ownership(self):
+        self._ownership = None
+        self._hh_position = None
+
+    def hh_position(self, hh_id):
+        self.ownership
+        return self._hh_position[hh_id]
+
+    # Sum each layer of a (t, y, x) cube over the cells owned by each
+    # household. Returns an array of shape (t, n_households) with columns in
+    # hh_ids() order. Unowned cells are dropped. With n_workers > 1 the
+    # households are split into groups with similar numbers of cells, which
+    # are reduced on a thread pool, each into its own columns of the result.
+
+    def aggregate_hh(self, cube, out = None, n_workers = None, index = None):
+        if index is None:
+            index = self.ownership
+        if n_workers is None:
+            n_workers = self.n_workers
+        if out is None:
+            out = np.zeros((cube.shape[0], index.n_labels), np.double)
+        if n_workers > 1:
+            task = lambda g: self.aggregate_hh(cube, out[:,g[0]:g[1]], 1, index.subset(*g))
+            with ThreadPoolExecutor(n_workers) as ex:
+                list(ex.map(task, index.split(n_workers)))
+            return out
+        out[:] = index.sum(cube)
+        return out
+
+    # Per-household profit for every layer of the elevation cube. The cells
+    # of each household are gathered from chunk_size layers at a time into a
+    # reused buffer, where the profit is evaluated in place and summed, so
+    # that no profit raster is ever held in memory.
+
+    def calc_hh_profit(self, water_level, k, elevation_cube = None, chunk_size = 1, out = None,
+                       n_workers = None, index = None):
+        if elevation_cube is None:
+            elevation_cube = self.elevation_cube
+        if index is None:
+            index = self.ownership
+        if n_workers is None:
+            n_workers = self.n_workers
+        n_layers = elevation_cube.shape[0]
+        if out is None:
+            out = np.zeros((n_layers, index.n_labels), np.double)
+        if n_layers == 0:
+            return out
+        if n_workers > 1:
+            task = lambda g: self.calc_hh_profit(water_level, k, elevation_cube, chunk_size,
+                                                 out[:,g[0]:g[1]], 1, index.subset(*g))
+            with ThreadPoolExecutor(n_workers) as ex:
+                list(ex.map(task, index.split(n_workers)))
+            return out
+        chunk_size = max(1, min(int(chunk_size), n_layers))
+        buf = np.empty((chunk_size, index.cells.size), np.double)
+        for start in range(0, n_layers, chunk_size):
+            stop = min(start + chunk_size, n_layers)
+            profit = buf[:(stop - start)]
+            index.gather(elevation_cube[start:stop], out = profit)
+            logit(profit, k, water_level / 2.0, out = profit)
+            profit *= self.max_profit
+            out[start:stop] = index.reduce_gathered(np.add, profit, 0.0)
+        return out
+
+    # Discounted sum over years of a (t, n_households) profit array, using
+    # each household's own discount rate.
+
+    def discount_hh(self, hh_profit):
+        t = np.arange(hh_profit.shape[0], dtype = np.double)
+        weights = np.exp(- np.outer(t, self.hh_discount()))
+        return np.sum(hh_profit * weights, axis = 0)
+
+    # Paint per-household values onto the owners raster. hh_values is either
+    # a dict keyed by household id or an array in hh_ids() order; unowned
+    # cells are set to zero.
+
+    def paint_hh(self, hh_values, out = None):
+        if isinstance(hh_values, dict):
+            hh_values = [ hh_values[hh_id] for hh_id in self.households.keys() ]
+        return self.ownership.paint(np.asarray(hh_values, np.double), out)
+
+    # Count, sum, mean, min and max of a raster over each household's cells,
+    # as a DataFrame indexed by household id.
+
+    def hh_stats(self, raster):
+        return pd.DataFrame(self.ownership.stats(raster), index = self.hh_ids())
+
+    def calc_eu(self, profit_cube = None, save = True, n_workers = None):
         if profit_cube is None:
-            profit_cube = self.profit.copy()
-        hh_eu = dict([(hh.id, hh.utility(profit_cube)) for hh in self.households.values()])
-        eu = np.zeros_like(self.owners, np.double)
-        for i in range(eu.shape[0]):
-            for j in range(eu.shape[1]):
-                eu[i,j] = hh_eu[self.owners[i,j]]
+            profit_cube = self.profit
+        hh_profit = self.aggregate_hh(profit_cube, n_workers = n_workers)
+        hh_eu = dict(zip(self.hh_ids(), self.discount_hh(hh_profit)))
+        eu = self.paint_hh(hh_eu)
         if save:
-            self.eu = eu.copy()
+            self.eu = read_only(eu.copy())
         return (eu, hh_eu)
 
+    # New preferences replace whatever the cached household profits of the
+    # last saved series were painting, so those are dropped; calc_eu_series
+    # sets them again when it saves.
+
     def set_hh_eu(self, ids, eu_array):
-        n_years = eu_array.shape[0]
+        ids = list(ids)
+        self.hh_profit = None
+        self.preferences = preferences(ids, eu_array.T)
         for i, hh_id in enumerate(ids):
-            df = pd.DataFrame({'year':range(n_years), 'eu':eu_array[:,i]})
-            self.households[hh_id].set_eu(df)
-
-    def calc_eu_slice(self, trm_water_level, trm_k, wl_water_level, wl_k, ec, horizon, duration):
-            ec1 = ec.copy()
-            profit = np.zeros_like(ec, np.double)
-            for j in range(duration + 1, horizon + 1):
-                ec1[j] = ec1[duration]
-            profit[:duration] = self.calc_profit(trm_water_level, trm_k, ec1[:duration], False)
-            profit[duration:] = self.calc_profit(wl_water_level, wl_k, ec1[duration:], False)
-            eu, hh_eu = self.calc_eu(profit, False)
+            self.households[hh_id].set_preferences(self.preferences, i)
+
+    # Discounted EU of every TRM duration from per-household profits, where
+    # trm_hh[t] and wl_hh[t] are the profits of layer t of the elevation cube
+    # under TRM and under waterlogging. TRM for d years earns trm_hh[t] for
+    # t < d, after which the land stays at layer d and earns wl_hh[d] up to
+    # the horizon, so both parts follow from running sums over years.
+
+    def eu_from_hh_profit(self, trm_hh, wl_hh, horizon = None, out = None, discount = None):
+        if horizon is None:
+            horizon = wl_hh.shape[0]
+        if out is None:
+            out = np.empty((horizon, wl_hh.shape[1]), np.double)
+        if discount is None:
+            discount = self.hh_discount()
+        t = np.arange(horizon + 1, dtype = np.double)
+        weights = np.exp(- np.outer(t, discount))
+        tail = np.cumsum(weights[::-1], axis = 0)[::-1]
+        out[0] = 0.0
+        np.cumsum(trm_hh[:(horizon - 1)] * weights[:(horizon - 1)], axis = 0, out = out[1:])
+        out += wl_hh[:horizon] * tail[:horizon]
+        return out
+
+    def calc_eu_slice(self, trm_water_level, trm_k, wl_water_level, wl_k, ec, horizon, duration, raster = True,
+                      n_workers = None):
+            hh_profit = np.empty((horizon + 1, len(self.households)), np.double)
+            self.calc_hh_profit(trm_water_level, trm_k, ec[:duration], out = hh_profit[:duration],
+                                n_workers = n_workers)
+            self.calc_hh_profit(wl_water_level, wl_k, ec[duration:(duration + 1)],
+                                out = hh_profit[duration:(duration + 1)], n_workers = n_workers)
+            hh_profit[(duration + 1):] = hh_profit[duration]
+            hh_eu = dict(zip(self.hh_ids(), self.discount_hh(hh_profit)))
+            eu = self.paint_hh(hh_eu) if raster else None
             return(eu, hh_eu)
 
-    def calc_eu_series(self, trm_water_level, trm_k, wl_water_level, wl_k, horizon = None, elevation_cube = None, save = True):
+    #==========================================================================
+    # LAND TRANSFERS
+    #==========================================================================
+
+    # Give plot i (a row of self.plots) to household new_owner. Only the
+    # plot's own cells are touched: they are repainted in owners, moved
+    # between the two households' segments of the ownership index, and
+    # their elevation and profit are subtracted from the old owner's cached
+    # land, wealth, per-year profit and EU and added to the new owner's.
+    # Wealth changes by the difference in land value, so money already
+    # paid or received in auctions is kept. Preferences are only updated
+    # when they come from a series saved by calc_eu_series, whose profits
+    # and elevation cube are cached; any other preferences are left as
+    # they are.
+
+    def transfer_plot(self, i, new_owner):
+        p = self.plots[i]
+        old_owner = p[4]
+        if old_owner == new_owner:
+            return
+        old_hh = self.households[old_owner]
+        new_hh = self.households[new_owner]
+        a = self.hh_position(old_owner)
+        b = self.hh_position(new_owner)
+        rows = slice(max(p[1], 0), max(p[1] + p[3], 0))
+        cols = slice(max(p[0], 0), max(p[0] + p[2], 0))
+        cells = np.ravel_multi_index(np.mgrid[rows, cols].reshape((2, -1)), self.owners.shape)
+
+        self.owners[rows, cols] = new_owner
+        self.ownership.move_cells(cells, a, b)
+        j = [ k for k, q in enumerate(old_hh.plots) if np.array_equal(q[:4], p[:4]) ][0]
+        new_hh.plots.append(old_hh.plots.pop(j))
+        p[4] = new_owner
+
+        if self.hh_land is not None:
+            old_value = self.land_value(*self.hh_land[:,[a, b]])
+            delta = np.array([cells.size, self.elevation.ravel()[cells].sum()])
+            self.hh_land[:,a] -= delta
+            self.hh_land[:,b] += delta
+            change = self.land_value(*self.hh_land[:,[a, b]]) - old_value
+            old_hh.wealth += change[0]
+            new_hh.wealth += change[1]
+
+        if self.hh_profit is not None:
+            trm_water_level, trm_k, wl_water_level, wl_k = self.hh_profit['params']
+            ec = self.hh_profit['elevation_cube']
+            z = ec.reshape((ec.shape[0], -1))[:,cells]
+            for key, water_level, k in (('trm', trm_water_level, trm_k), ('wl', wl_water_level, wl_k)):
+                profit = self.max_profit * logit(z, k, water_level / 2.0).sum(axis = 1)
+                self.hh_profit[key][:,a] -= profit
+                self.hh_profit[key][:,b] += profit
+                if self.ownership.counts[a] == 0:
+                    self.hh_profit[key][:,a] = 0.0
+            ab = [a, b]
+            eu = self.eu_from_hh_profit(self.hh_profit['trm'][:,ab], self.hh_profit['wl'][:,ab],
+                                        discount = [old_hh.discount, new_hh.discount])
+            self.hh_profit['eu'][:,ab] = eu
+            self.preferences.update_rows(ab, eu.T)
+            old_hh._eu_df = None
+            new_hh._eu_df = None
+
+    def transfer_plots(self, plots, new_owners):
+        for i, new_owner in zip(plots, new_owners):
+            self.transfer_plot(i, new_owner)
+
+    # Each layer of the elevation cube is evaluated once under TRM and once
+    # under waterlogging, and every duration is assembled from those. With
+    # executor = 'thread' the per-household reductions run over row bands on
+    # a pool of n_workers threads; with executor = 'process' the layers are
+    # spread over n_workers forked processes, which share the elevation cube
+    # read-only. Either way row i of the result is duration i.
+
+    def calc_eu_series(self, trm_water_level, trm_k, wl_water_level, wl_k, horizon = None, elevation_cube = None, save = True,
+                       n_workers = None, executor = 'thread'):
         if horizon is None:
             horizon = self.time_horizon
         if elevation_cube is None:
             elevation_cube = self.elevation_cube
-        eu_cube = np.zeros((horizon , self.elevation.shape[0], self.elevation.shape[1]), np.double)
-        ec0 = elevation_cube[:horizon+1].copy()
-        hh_eu_array = np.zeros((horizon, len(self.households)))
+        if n_workers is None:
+            n_workers = self.n_workers
+        if executor not in ('thread', 'process'):
+            raise ValueError("Unknown executor %s" % executor)
+        ec0 = read_only(elevation_cube[:horizon])
+        trm_hh = np.empty((horizon, len(self.households)), np.double)
+        wl_hh = np.empty((horizon, len(self.households)), np.double)
         hh_id_list = self.households.keys()
-        for i in range(horizon):
-            eu, hh_eu = self.calc_eu_slice(trm_water_level, trm_k, wl_water_level, wl_k, ec0, horizon, i)
-            eu_cube[i] = eu.copy()
-            hh_eu_array[i] = [hh_eu[hh_id].copy() for hh_id in hh_id_list]
-        self.eu_cube = eu_cube.copy()
+        if executor == 'process' and n_workers > 1:
+            layers = np.array_split(np.arange(horizon), min(n_workers, horizon))
+            _hh_profit_state['polder'] = self
+            _hh_profit_state['args'] = (trm_water_level, trm_k, wl_water_level, wl_k, ec0)
+            try:
+                with mp.get_context('fork').Pool(len(layers)) as pool:
+                    results = pool.map(_hh_profit_task, [ (l[0], l[-1] + 1) for l in layers ])
+            finally:
+                _hh_profit_state.clear()
+            for l, (trm_part, wl_part) in zip(layers, results):
+                trm_hh[l] = trm_part
+                wl_hh[l] = wl_part
+        else:
+            self.calc_hh_profit(trm_water_level, trm_k, ec0, out = trm_hh, n_workers = n_workers)
+            self.calc_hh_profit(wl_water_level, wl_k, ec0, out = wl_hh, n_workers = n_workers)
+        eu = self.eu_from_hh_profit(trm_hh, wl_hh, horizon)
+        hh_eu_array = read_only(eu)
         self.set_hh_eu(hh_id_list, hh_eu_array)
-        return eu_cube
+        if save:
+            # the cube is copied, since aggrade and coupled_step change the
+            # live one under the cached profits
+            self.hh_eu_array = hh_eu_array
+            self.hh_profit = {'trm':trm_hh, 'wl':wl_hh, 'eu':eu, 'elevation_cube':read_only(ec0.copy()),
+                              'params':(trm_water_level, trm_k, wl_water_level, wl_k)}
+        return hh_eu_array
+
+    # EU rasters are not kept by calc_eu_series; they are painted on demand
+    # from the household EU of the last series and the owners map, only for
+    # the TRM durations asked for (all of them by default).
+
+    def eu_raster(self, duration, out = None):
+        return self.paint_hh(self.hh_eu_array[duration], out)
+
+    def eu_rasters(self, durations = None):
+        if durations is None:
+            durations = range(self.hh_eu_array.shape[0])
+        durations = list(durations)
+        euc = np.empty((len(durations),) + self.owners.shape, np.double)
+        for i, d in enumerate(durations):
+            self.eu_raster(d, euc[i])
+        return euc
 
     def add_breach(self, breach_x, breach_y, duration):
         self.breach_duration = duration,
@@ -521,21 +1292,354 @@ class polder(object):
         for b in self.breaches:
             sed_load += SSC * b.scaled_dist ** -2.3
         new_layer = self.elevation_cube[period - 1]
-        new_layer = aggrade_patches(heads, heads.index, ws, rho, sed_load, dP, dO, new_layer, self.border_height)
+        if self.carry_sediment:
+            if self.sediment_cube is None:
+                self.sediment_cube = np.zeros_like(self.elevation_cube)
+            new_layer, C = aggrade_patches(heads, heads.index, ws, rho, sed_load, dP, dO, new_layer,
+                                           self.border_height, self.sediment_cube[period - 1], True)
+            self.sediment_cube[period] = C
+        else:
+            new_layer = aggrade_patches(heads, heads.index, ws, rho, sed_load, dP, dO, new_layer, self.border_height)
         self.elevation_cube[period] = new_layer
         self.current_period = period
 
+    #==========================================================================
+    # COUPLED SIMULATION
+    #==========================================================================
+
+    # One year of the coupled model. Layers 0 .. horizon - 1 of the
+    # elevation cube are a rolling forecast: layer i is the land after i
+    # years of TRM from the current elevation (layer 0). The households
+    # vote on a TRM duration over it (decide returns the winner; by default
+    # an instant-runoff election) and TRM runs this year if the winner is
+    # not 0.
+    #
+    # Aggradation only depends on the previous layer, so the forecast is
+    # kept between years: after a year of TRM the new state is layer 1 and
+    # the next forecast is the old one shifted down a layer, with one new
+    # year aggraded at the end. Without TRM the land only changes by the
+    # drift dO - dP; with no drift the whole forecast is reused, otherwise
+    # it is recomputed from the new state. reuse = False recomputes every
+    # year, for comparison.
+
+    def coupled_step(self, heads, ws, rho, SSC, dP, dO, horizon,
+                     trm_water_level, trm_k, wl_water_level, wl_k, decide = None, reuse = True):
+        assert(horizon >= 2 and horizon <= self.time_horizon + 1)
+        if decide is None:
+            decide = lambda pdr: election(pdr.households, pdr.preferences).vote()[0]
+        if not reuse:
+            self.forecast_layers = 1
+        self.elevation_cube[0] = self.elevation
+        aggraded = 0
+        for period in range(max(self.forecast_layers, 1), horizon):
+            self.aggrade(heads, ws, rho, SSC, dP, dO, period)
+            aggraded += 1
+        self.forecast_layers = horizon
+        self.calc_eu_series(trm_water_level, trm_k, wl_water_level, wl_k, horizon)
+        winner = decide(self)
+        adopted = winner > 0
+        if adopted:
+            self.elevation = self.elevation_cube[1].copy()
+            self.elevation_cube[:(horizon - 1)] = self.elevation_cube[1:horizon]
+            if self.sediment_cube is not None:
+                self.sediment_cube[:(horizon - 1)] = self.sediment_cube[1:horizon]
+            self.forecast_layers = horizon - 1
+        else:
+            if dO != dP:
+                self.elevation = self.elevation + (dO - dP) * (len(heads) - 1)
+                self.elevation_cube[0] = self.elevation
+                self.forecast_layers = 1
+            # the sediment in the water settles or drains in a year without TRM
+            if self.sediment_cube is not None and self.sediment_cube[0].any():
+                self.sediment_cube[0] = 0.0
+                self.forecast_layers = 1
+        self.history.append({'year':self.year, 'winner':winner, 'adopted':adopted, 'aggraded':aggraded,
+                             'mean_elevation':self.elevation.mean()})
+        self.year += 1
+        return winner
+
+    # Run the coupled model up to year n_years (from self.year, so that a
+    # polder restored from a checkpoint carries on where it stopped), saving
+    # a checkpoint every checkpoint_every years if a checkpoint path is given.
+    # rngs names the generators decide draws from outside the polder, which
+    # go into each checkpoint for load_checkpoint(path, rngs) to restore.
+
+    def run_coupled(self, n_years, heads, ws, rho, SSC, dP, dO, horizon,
+                    trm_water_level, trm_k, wl_water_level, wl_k, decide = None, reuse = True,
+                    checkpoint = None, checkpoint_every = 1, rngs = None):
+        while self.year < n_years:
+            self.coupled_step(heads, ws, rho, SSC, dP, dO, horizon,
+                              trm_water_level, trm_k, wl_water_level, wl_k, decide, reuse)
+            if checkpoint is not None and (self.year % checkpoint_every == 0 or self.year == n_years):
+                self.save_checkpoint(checkpoint, rngs = rngs)
+        return pd.DataFrame(self.history).set_index('year')
+
+    #==========================================================================
+    # CHECKPOINTS
+    #==========================================================================
+
+    # Everything needed to carry on a run exactly, in one uncompressed npz
+    # (compress = True trades restore speed for size): the elevation cube up
+    # to the last layer in use, owners and plots, the households' wealth and
+    # discount rates, the EU of the last series, breaches, the suspended
+    # sediment carried over, the state of the polder's random numbers and
+    # the coupled model's year, forecast and history. Scalars go into one
+    # JSON string. The file is written under a temporary name and renamed,
+    # so a crash while saving leaves the previous checkpoint intact.
+    #
+    # Random states saved: the polder's, numpy's global state (which an
+    # auction without a seed draws from) when the polder has its own, and
+    # any RandomState in rngs, a dict of name -> RandomState for generators
+    # held outside the polder (the auction of a decide function, say), which
+    # load_checkpoint restores into the generators passed to it by name.
+
+    def save_checkpoint(self, path, compress = False, rngs = None):
+        n_layers = max(self.current_period + 1, self.forecast_layers, 1)
+        ids = self.hh_ids()
+        states = {'polder':self.rng.get_state()}
+        if self.rng is not np.random:
+            states['global'] = np.random.get_state()
+        for name, rng in (rngs or {}).items():
+            states['rng_' + name] = rng.get_state()
+        meta = {'width':self.width, 'height':self.height, 'time_horizon':self.time_horizon,
+                'border_height':self.border_height, 'max_wealth':self.max_wealth,
+                'max_profit':self.max_profit, 'n_workers':self.n_workers, 'plot_method':self.plot_method,
+                'current_period':self.current_period, 'breach_duration':list(np.ravel(self.breach_duration)),
+                'year':self.year, 'forecast_layers':self.forecast_layers, 'history':self.history,
+                'carry_sediment':self.carry_sediment,
+                'breaches':[ (b.x, b.y, b.z_breach, b.A) for b in self.breaches ],
+                'rng':dict((name, [state[0]] + list(state[2:])) for name, state in states.items()),
+                'global_rng':self.rng is np.random,
+                'hh_profit_params':None if self.hh_profit is None else self.hh_profit['params']}
+        arrays = {'meta':np.array(json.dumps(meta, default = to_builtin)),
+                  'elevation':self.elevation, 'elevation_cube':self.elevation_cube[:n_layers],
+                  'owners':self.owners, 'plots':self.plots, 'hh_ids':ids,
+                  'wealth':np.array([ self.households[i].wealth for i in ids ], np.double),
+                  'discount':self.hh_discount()}
+        for name, state in states.items():
+            arrays['rng_keys_' + name] = state[1]
+        if self.sediment_cube is not None:
+            arrays['sediment_cube'] = self.sediment_cube[:n_layers]
+        if self.hh_land is not None:
+            arrays['hh_land'] = self.hh_land
+        if getattr(self, 'hh_eu_array', None) is not None:
+            arrays['hh_eu_array'] = self.hh_eu_array
+        if self.hh_profit is not None:
+            arrays['hh_profit_trm'] = self.hh_profit['trm']
+            arrays['hh_profit_wl'] = self.hh_profit['wl']
+            arrays['hh_profit_elevation_cube'] = self.hh_profit['elevation_cube']
+        tmp = path + '.tmp.npz'
+        (np.savez_compressed if compress else np.savez)(tmp, **arrays)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load_checkpoint(path, rngs = None):
+        with np.load(path) as f:
+            arrays = dict((k, f[k]) for k in f.files)
+        meta = json.loads(str(arrays['meta']))
+        # seeded, so that building the empty polder does not draw from the
+        # global generator; its generator is replaced below
+        pdr = polder(meta['width'], meta['height'], meta['time_horizon'], max_wealth = meta['max_wealth'],
+                     max_profit = meta['max_profit'], border_height = meta['border_height'],
+                     amplitude = 0.0, noise = 0.0, n_workers = meta['n_workers'],
+                     plot_method = meta['plot_method'], seed = 0)
+        ids = arrays['hh_ids']
+        pdr.households = dict((i, household(id = i)) for i in ids)
+        pdr.plots = arrays['plots']
+        pdr.elevation = arrays['elevation']
+        pdr.set_hh_plots()
+        pdr.owners = arrays['owners']
+        if 'hh_land' in arrays:
+            pdr.hh_land = arrays['hh_land']
+        for i, w, d in zip(ids, arrays['wealth'], arrays['discount']):
+            pdr.households[i].wealth = w
+            pdr.households[i].discount = d
+        n_layers = arrays['elevation_cube'].shape[0]
+        pdr.elevation_cube[:n_layers] = arrays['elevation_cube']
+        pdr.current_period = meta['current_period']
+        pdr.breach_duration = tuple(meta['breach_duration'])
+        for x, y, z, A in meta['breaches']:
+            b = breach(pdr, x, y, z)
+            b.A = A
+            pdr.breaches.append(b)
+        pdr.carry_sediment = meta['carry_sediment']
+        if 'sediment_cube' in arrays:
+            pdr.sediment_cube = np.zeros_like(pdr.elevation_cube)
+            pdr.sediment_cube[:n_layers] = arrays['sediment_cube']
+        if 'hh_eu_array' in arrays:
+            pdr.hh_eu_array = read_only(arrays['hh_eu_array'])
+            pdr.set_hh_eu(ids, pdr.hh_eu_array)
+        if 'hh_profit_trm' in arrays:
+            eu = np.array(arrays['hh_eu_array'])
+            pdr.hh_eu_array = read_only(eu)
+            pdr.hh_profit = {'trm':arrays['hh_profit_trm'], 'wl':arrays['hh_profit_wl'], 'eu':eu,
+                             'elevation_cube':read_only(arrays['hh_profit_elevation_cube']),
+                             'params':tuple(meta['hh_profit_params'])}
+        pdr.year = meta['year']
+        pdr.forecast_layers = meta['forecast_layers']
+        pdr.history = meta['history']
+        states = dict((name, (state[0], arrays['rng_keys_' + name]) + tuple(state[1:]))
+                      for name, state in meta['rng'].items())
+        pdr.rng = np.random if meta['global_rng'] else np.random.RandomState()
+        pdr.rng.set_state(states['polder'])
+        if 'global' in states:
+            np.random.set_state(states['global'])
+        for name, rng in (rngs or {}).items():
+            rng.set_state(states['rng_' + name])
+        return pdr
+
 #%% Define functions
 
+# Inherited by the forked workers of calc_eu_series(executor = 'process'), so
+# that the polder and its elevation cube are not pickled for every task.
+
+_hh_profit_state = dict()
+
+def _hh_profit_task(layers):
+    pdr = _hh_profit_state['polder']
+    trm_water_level, trm_k, wl_water_level, wl_k, ec = _hh_profit_state['args']
+    ec = ec[layers[0]:layers[1]]
+    trm_hh = pdr.calc_hh_profit(trm_water_level, trm_k, ec, n_workers = 1)
+    wl_hh = pdr.calc_hh_profit(wl_water_level, wl_k, ec, n_workers = 1)
+    return (trm_hh, wl_hh)
+
+# A read-only view of an array, for handing out internal buffers without
+# copying them.
+
+def read_only(a):
+    v = a.view()
+    v.flags.writeable = False
+    return v
+
+# Cut a table of (x, y, dx, dy, owner) plots, clipped to a raster of the
+# given shape, into one run of cells per row each plot covers. Returns the
+# plot (row of the table) of every run and the run's start and stop as
+# indices into the raveled raster, sorted by start.
+
+def plot_runs(plots, shape):
+    x0 = np.clip(plots[:,0], 0, shape[1])
+    y0 = np.clip(plots[:,1], 0, shape[0])
+    x1 = np.clip(plots[:,0] + plots[:,2], x0, shape[1])
+    y1 = np.clip(plots[:,1] + plots[:,3], y0, shape[0])
+    keep = np.flatnonzero((x1 > x0) & (y1 > y0))
+    n_rows = (y1 - y0)[keep]
+    plot = np.repeat(keep, n_rows)
+    first = np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+    row = y0[plot] + np.arange(plot.size) - first
+    start = row * shape[1] + x0[plot]
+    order = np.argsort(start, kind = 'stable')
+    start = start[order]
+    plot = plot[order]
+    stop = start + (x1 - x0)[plot]
+    return (plot, start, stop)
+
+# Paint a table of (x, y, dx, dy, owner) rectangles into an owners raster of
+# the given shape, with -1 for cells outside every plot. Sorted by position
+# in the raveled raster, the runs of plot_runs and the gaps between them
+# become a single np.repeat. Runs that overlap mean the plots overlap, and
+# then the plots are painted one at a time, later plots winning, as before.
+
+def rasterize_plots(plots, shape, dtype = np.int64):
+    plots = np.asarray(plots).reshape((-1, 5))
+    plot, start, stop = plot_runs(plots, shape)
+    prev_stop = np.concatenate(([0], stop[:-1]))
+    if np.any(start < prev_stop):
+        owners = np.full(shape, -1, dtype = dtype)
+        for p in plots:
+            owners[p[1]:(p[1]+p[3]),p[0]:(p[0]+p[2])] = p[4]
+        return owners
+    values = np.empty(2 * plot.size + 1, dtype)
+    values[0:-1:2] = -1
+    values[1::2] = plots[plot,4]
+    values[-1] = -1
+    lengths = np.empty(2 * plot.size + 1, np.int64)
+    lengths[0:-1:2] = start - prev_stop
+    lengths[1::2] = stop - start
+    lengths[-1] = shape[0] * shape[1] - (stop[-1] if stop.size > 0 else 0)
+    return np.repeat(values, lengths).reshape(shape)
+
+# Instant runoff on (..., households, candidates) integer ballot matrices,
+# where each row lists the candidates from most to least preferred. Any
+# leading axes index independent elections, which are run side by side.
+# A candidate wins with more than half of the first preferences; until
+# then the candidate with the most last-place votes is eliminated (ties go
+# to the lowest candidate). The ballots are never rewritten: each one keeps
+# a pointer to its first and last remaining choice, which move inward past
+# eliminated candidates, so a round costs O(elections x households).
+# Without households every candidate ties and the lowest one wins.
+
+def instant_runoff(ballots):
+    ballots = np.asarray(ballots)
+    batch_shape = ballots.shape[:-2]
+    n_hh, n_choices = ballots.shape[-2:]
+    n_elections = int(np.prod(batch_shape))
+    if n_choices == 0:
+        raise ValueError("No candidates to elect")
+    if n_hh == 0:
+        # no ballots: every candidate ties, and ties go to the lowest
+        winner = np.zeros(n_elections, np.intp)
+        return winner.reshape(batch_shape) if batch_shape else winner[0]
+    ballots = ballots.reshape((n_elections, n_hh, n_choices))
+    majority = n_hh * 0.5
+    rows = np.arange(n_elections)[:,np.newaxis]
+    cols = np.arange(n_hh)[np.newaxis,:]
+    offset = rows * n_choices
+    eliminated = np.zeros((n_elections, n_choices), bool)
+    first = np.zeros((n_elections, n_hh), np.intp)
+    last = np.full((n_elections, n_hh), n_choices - 1, np.intp)
+    winner = np.full(n_elections, -1, np.intp)
+    open_ = np.ones(n_elections, bool)
+    while open_.any():
+        top = ballots[rows, cols, first]
+        votes = np.bincount((top + offset).ravel(), minlength = n_elections * n_choices)
+        votes = votes.reshape((n_elections, n_choices))
+        leader = votes.argmax(axis = 1)
+        done = open_ & (votes[rows[:,0], leader] > majority)
+        winner[done] = leader[done]
+        open_ &= ~ done
+        if not open_.any():
+            break
+        bottom = ballots[rows, cols, last]
+        votes = np.bincount((bottom + offset).ravel(), minlength = n_elections * n_choices)
+        loser = votes.reshape((n_elections, n_choices)).argmax(axis = 1)
+        e = np.flatnonzero(open_)
+        eliminated[e, loser[e]] = True
+        for pointer, step in ((first, 1), (last, -1)):
+            move = eliminated[rows, ballots[rows, cols, pointer]] & open_[:,np.newaxis]
+            while move.any():
+                pointer[move] += step
+                move[move] = eliminated[rows, ballots[rows, cols, pointer]][move]
+    return winner.reshape(batch_shape) if batch_shape else winner[0]
+
+def bid_dtype(id_dtype = np.int64):
+    return np.dtype([('id', id_dtype), ('year', np.int64), ('is_offer', bool), ('amount', np.double)])
+
+def trade_dtype(id_dtype = np.int64):
+    return np.dtype([('buyer', id_dtype), ('seller', id_dtype), ('year', np.int64), ('price', np.double)])
+
+def ledger_dtype():
+    return np.dtype([('buyer', np.int64), ('seller', np.int64), ('year', np.int64),
+                     ('price', np.double), ('round', np.int64)])
+
+# Numpy scalars (as found in polder.history) as plain Python values for json.
+
+def to_builtin(x):
+    if isinstance(x, np.generic):
+        return x.item()
+    raise TypeError("Cannot convert %r to JSON" % (x,))
+
 def load_tides(file,parser,start,end):
     df = pd.read_csv(file,parse_dates=['datetime'],date_parser=parser,index_col='datetime')
     df1 = df[(df.index >= start) & (df.index < end) & (df.index.minute == 0)]
     df2 = df1['pressure'] - np.mean(df1['pressure'])
     return df2
 
-def aggrade_patches(heads,times,ws,rho,SSC,dP,dO,z0, z_breach):
+# C0 is the suspended sediment left in the water at the start (none by
+# default); with return_C the concentration at the end is returned too.
+
+def aggrade_patches(heads,times,ws,rho,SSC,dP,dO,z0, z_breach, C0 = None, return_C = False):
     z = z0.copy()
-    C_last = np.zeros_like(z0)
+    C_last = np.zeros_like(z0) if C0 is None else np.array(C0, dtype = np.double)
     dt = float((times[1]-times[0]).seconds)
     delta_h = (heads.values[1:] - heads.values[:-1])
     for h, dh in zip(heads[1:], delta_h):
@@ -553,16 +1657,29 @@ def aggrade_patches(heads,times,ws,rho,SSC,dP,dO,z0, z_breach):
         dz = C_last * ws * dt / rho
         z += dz + dO - dP
         # print "Sum(dz) = ", np.sum(dz), ", Sum(C_last) = ", np.sum(C_last)
+    if return_C:
+        return (z, C_last)
     return (z)
 
-def logit(z,k,mid):
-    x = 1.0 / (1.0 + np.exp(-k*(z-mid)))
-    return x
+# With out given, the logit is evaluated in place in that buffer, without
+# allocating any temporaries the size of z.
+
+def logit(z,k,mid,out=None):
+    if out is None:
+        x = 1.0 / (1.0 + np.exp(-k*(z-mid)))
+        return x
+    np.subtract(z, mid, out=out)
+    np.multiply(out, -k, out=out)
+    np.exp(out, out=out)
+    np.add(out, 1.0, out=out)
+    np.reciprocal(out, out=out)
+    return out
 
 def calc_trm(pdr, discount, horizon, trm_k = 2.0, wl_k = 1.0):
     global euc
     for hh in pdr.households.values(): hh.discount = discount
-    euc = pdr.calc_eu_series(MHW, trm_k, MW, wl_k, horizon)
+    pdr.calc_eu_series(MHW, trm_k, MW, wl_k, horizon)
+    euc = pdr.eu_rasters()
     d_euc = euc[1:] - euc[0]
     dem = max(d_euc.max(), -d_euc.min())
     for i in range(d_euc.shape[0]):
@@ -727,12 +1844,12 @@ def runit(force = False):
     global elevation_cube, a, v, a_res, v_res
 
     plt.ioff()
-    if os.path.exists('elevation_cube.pickle') and not force:
-        elevation_cube = pickle.load(open('elevation_cube.pickle', 'rb'))
+    if os.path.exists('elevation_cube.trm') and not force:
+        elevation_cube = artifact('elevation_cube.trm').read('elevation_cube')
         test(elevation_cube)
     else:
         test()
-        pickle.dump(elevation_cube, open('elevation_cube.pickle', 'wb'))
+        write_artifact('elevation_cube.trm', {'elevation_cube':elevation_cube}, compress = 1)
 
 
     plt.draw()
@@ -751,9 +1868,10 @@ def batch(force = False, trm_k = 5.0):
     ares_list = []
     if not os.path.exists('batch'):
         os.mkdir('batch')
-    pickle.dump(elevation_cube, open(os.path.join('batch', 'elevation_cube.pickle'), 'wb'))
-    pickle.dump(pdr.owners, open(os.path.join('batch', 'owners.pickle'), 'wb'))
-    pickle.dump(pdr.plots, open(os.path.join('batch', 'plots.pickle'), 'wb'))
+    write_artifact(os.path.join('batch', 'run.trm'),
+                   {'elevation_cube':elevation_cube, 'owners':pdr.owners, 'plots':pdr.plots},
+                   meta = {'trm_k':trm_k, 'MHW':MHW, 'MW':MW, 'n_households':len(pdr.households)},
+                   compress = {'elevation_cube':1})
     # trm_profit = pdr.calc_profit(MHW, 5.0, elevation_cube, False)
     # wl_profit = pdr.calc_profit(MW, 1.0, elevation_cube, False)
     for horizon in range(3,7):
@@ -769,4 +1887,5 @@ def batch(force = False, trm_k = 5.0):
         print("Auction: winner = ", ares[0], " min utility = ", min(ares[1].values()), ", ", a.count_unhappy(ares[0]), " unhappy households")
 
 #%% Run program
-runit()
\ No newline at end of file
+if __name__ == '__main__':
+    runit()
\ No newline at end of file
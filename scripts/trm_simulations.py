@@ -83,10 +83,14 @@ D = breach_dist / 1000 + 1 # distance to breach in km + 1 km (for scaling purpos
 
 time_horizon = 5
 
+# Per-household sums and means of a raster in one pass over polderHH
+hh_cells = np.bincount(polderHH.ravel(), minlength = N)
+hh_sum = lambda a: np.bincount(polderHH.ravel(), weights = a.ravel(), minlength = N)
+hh_mean = lambda a: hh_sum(a) / hh_cells
+
 # Calculate mean elevation and initial wealth of household parcels
-for hh in range(N):
-    df.set_value(hh,'elevation',np.mean(Z[polderHH == hh]))
-    df.set_value(hh,'wealth',df.loc[hh].elevation/alpha*max_wealth)
+df['elevation'] = hh_mean(Z)
+df['wealth'] = df.elevation / alpha * max_wealth
 
 best_z = 3
 vote = []
@@ -123,20 +127,18 @@ for t in range(time):
         wl_risk.append(1 - abm.logit(Z_all[tt],5,MHW/2))
         profit.append(abm.update_profit(Z_all[tt],MW,best_z,max_profit))
 
+    # per-household reductions, with rows = years of the time horizon
+    discount = ((1-dr) ** np.arange(time_horizon))[:,np.newaxis]
+    p = hh_sum(profit[0]) * discount
+    p_trm = np.array([hh_sum(profit[tt+1]) for tt in range(time_horizon)]) * discount
+    r = hh_mean(wl_risk[0]) * discount
+    r_trm = np.array([hh_mean(flood_risk[tt+1]) for tt in range(time_horizon)]) * discount
+
     for hh in range(N):
-        p = []
-        p_trm = []
-        r = []
-        r_trm = []
-        for tt in range(time_horizon):
-            p.append(np.sum([profit[0][polderHH==hh]])*(1-dr)**tt)
-            p_trm.append(np.sum(profit[tt+1][polderHH==hh])*(1-dr)**tt)
-            r.append(np.mean([wl_risk[0][polderHH==hh]])*(1-dr)**tt)
-            r_trm.append(np.mean([flood_risk[tt+1][polderHH==hh]])*(1-dr)**tt)
-        profit_base = np.sum(p)
-        profit_trm = np.sum(p_trm)
-        risk_base = np.mean(r)
-        risk_trm = np.mean(r_trm)
+        profit_base = np.sum(p[:,hh])
+        profit_trm = np.sum(p_trm[:,hh])
+        risk_base = np.mean(r[:,hh])
+        risk_trm = np.mean(r_trm[:,hh])
 
         eu_base = (df.loc[hh].wealth + profit_base) * (1 - risk_base)
         eu_trm = (df.loc[hh].wealth  + profit_trm) * (1 - risk_trm)
@@ -0,0 +1,76 @@
+#%% Import packages
+import numpy as np
+import pandas as pd
+
+from trm import preferences
+
+#%% Define functions
+
+metrics = ('unhappy', 'min_utility', 'mean_utility', 'gini', 'loss', 'winner_transfer', 'loser_transfer')
+
+# Welfare of every candidate year at once, from the (household, year) EU
+# matrix and, for an auction, its net transfers net[year, household] (what
+# each household received for votes that year, negative if it paid).
+# Returns a (year x metric) array with the columns in the order of metrics:
+#   unhappy          households whose favorite is not the year and whose
+#                    utility is below their best EU (auction.unhappy_mask)
+#   min_utility      lowest utility
+#   mean_utility     mean utility
+#   gini             Gini coefficient of utility
+#   loss             total shortfall of utility below the best EU
+#   winner_transfer  paid, net, by the households whose favorite is the year
+#   loser_transfer   received, net, by the other households
+
+def welfare_array(eu, net = None):
+    eu = np.asarray(eu, np.double)
+    n_hh, n_years = eu.shape
+    if net is None:
+        u = eu
+        net = np.zeros((n_years, n_hh), np.double)
+    else:
+        u = eu + net.T
+    favorite = eu.argmax(axis = 1)
+    best = eu.max(axis = 1)
+    winner = favorite[:,np.newaxis] == np.arange(n_years)[np.newaxis,:]
+    shortfall = best[:,np.newaxis] - u
+    out = np.empty((n_years, len(metrics)), np.double)
+    out[:,0] = np.count_nonzero(~ winner & (shortfall > 0), axis = 0)
+    out[:,1] = u.min(axis = 0)
+    out[:,2] = u.mean(axis = 0)
+    out[:,3] = gini(u)
+    out[:,4] = np.clip(shortfall, 0.0, None).sum(axis = 0)
+    out[:,5] = 0.0 - np.where(winner, net.T, 0.0).sum(axis = 0)
+    out[:,6] = np.where(winner, 0.0, net.T).sum(axis = 0)
+    return out
+
+def welfare_table(eu, net = None):
+    return pd.DataFrame(welfare_array(eu, net), columns = metrics).rename_axis('year')
+
+# Gini coefficient of each column of x, from the sorted values:
+# G = sum_i (2 i - n - 1) x_(i) / (n sum_i x_(i)), i = 1..n.
+
+def gini(x):
+    x = np.sort(np.asarray(x, np.double), axis = 0)
+    n = x.shape[0]
+    weights = 2.0 * np.arange(1, n + 1) - n - 1
+    total = x.sum(axis = 0)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        g = np.dot(weights, x) / (n * total)
+    return np.where(total != 0, g, 0.0)
+
+# Welfare of the winner of every decision rule. results maps the name of a
+# rule to its winner, or to (winner, net) for rules with transfers, such
+# as the auction (net = auction.ledger.net).
+
+def rule_welfare(prefs, results):
+    if not isinstance(prefs, preferences):
+        prefs = preferences.from_households(prefs)
+    tables = dict()
+    rows = []
+    for name, result in results.items():
+        winner, net = result if isinstance(result, tuple) else (result, None)
+        key = id(net)
+        if key not in tables:
+            tables[key] = welfare_array(prefs.eu, net)
+        rows.append((name, winner) + tuple(tables[key][winner]))
+    return pd.DataFrame(rows, columns = ('rule', 'winner') + metrics).set_index('rule')